@@ -0,0 +1,106 @@
+"""
+Benchmark della preparazione dell'audio per Whisper, suddiviso per formato contenitore.
+
+Genera video di prova con ffmpeg (lavfi) e, per ciascun formato, misura il tempo
+di estrazione PIÙ la decodifica/ricampionamento che faster-whisper esegue prima
+della trascrizione (faster_whisper.decode_audio). Con la copia diretta la
+decodifica non sparisce, si sposta dentro faster-whisper: solo il totale è
+confrontabile.
+- legacy: estrazione originale in WAV 16 kHz mono (ffmpeg sceglie da sé la traccia
+          audio, il video non viene comunque decodificato per un'uscita WAV);
+- decode: prima traccia audio selezionata esplicitamente, decodificata in WAV;
+- copy:   copia della traccia audio in Matroska, decodificata poi da faster-whisper;
+- cache:  seconda chiamata a extract_audio sullo stesso file (solo lettura dalla cache).
+
+Richiede ffmpeg/ffprobe nel PATH, ffmpeg-python e faster-whisper installati.
+
+Uso:
+    python benchmarks/bench_extraction.py --minutes 10
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+import ffmpeg
+from faster_whisper import decode_audio
+
+# Formato -> (codec video, codec audio)
+CONTAINERS = {
+    "mp4": ("libx264", "aac"),
+    "mkv": ("libx264", "libopus"),
+    "mov": ("libx264", "aac"),
+    "avi": ("mpeg4", "libmp3lame"),
+    "webm": ("libvpx-vp9", "libopus"),
+}
+
+def _make_sample(path, minutes, vcodec, acodec):
+    """Crea un video di prova (immagine di test 720p + tono sinusoidale)."""
+    seconds = minutes * 60
+    video = ffmpeg.input(f"testsrc=size=1280x720:rate=25:duration={seconds}", f="lavfi")
+    audio = ffmpeg.input(f"sine=frequency=440:sample_rate=48000:duration={seconds}", f="lavfi")
+    ffmpeg.output(video, audio, path, vcodec=vcodec, acodec=acodec, preset="ultrafast", shortest=None) \
+        .overwrite_output().run(quiet=True)
+
+def _legacy_extraction(video_path, output_path):
+    """Estrazione originale: WAV 16 kHz mono senza selezione esplicita della traccia."""
+    ffmpeg.input(video_path).output(output_path, acodec='pcm_s16le', ar='16000', ac=1) \
+        .overwrite_output().run(quiet=True)
+    return output_path
+
+def _timed_until_whisper_input(extract, *args, **kwargs):
+    """
+    Secondi per estrazione e decodifica fino ai campioni che Whisper riceve.
+
+    Returns:
+        Coppia (secondi di sola estrazione, secondi totali).
+    """
+    start = time.perf_counter()
+    audio_path = extract(*args, **kwargs)
+    extracted = time.perf_counter() - start
+    decode_audio(audio_path, sampling_rate=16000)
+    return extracted, time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dell'estrazione audio di DeepNotes per contenitore.")
+    parser.add_argument("--minutes", type=float, default=10, help="Durata dei video di prova (minuti)")
+    parser.add_argument("--formats", nargs="+", default=list(CONTAINERS), help="Contenitori da provare")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="deepnotes_bench_")
+    # Cache isolata per non sporcare quella dell'utente
+    os.environ["DEEPNOTES_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    from python_backend.video_to_text import _run_extraction, extract_audio
+
+    try:
+        def run_extraction(sample, output_path, copy):
+            _run_extraction(sample, output_path, copy=copy)
+            return output_path
+
+        # Ogni cella: secondi di estrazione / secondi totali fino all'input di Whisper
+        print("secondi: estrazione / estrazione + decodifica per Whisper")
+        print(f"{'formato':>8} {'legacy':>13} {'decode':>13} {'copy':>13} {'cache':>13}")
+        for fmt in args.formats:
+            vcodec, acodec = CONTAINERS[fmt]
+            sample = os.path.join(work_dir, f"sample.{fmt}")
+            _make_sample(sample, args.minutes, vcodec, acodec)
+
+            timings = [
+                _timed_until_whisper_input(_legacy_extraction, sample, os.path.join(work_dir, "legacy.wav")),
+                _timed_until_whisper_input(run_extraction, sample, os.path.join(work_dir, "decode.wav"), False),
+                _timed_until_whisper_input(run_extraction, sample, os.path.join(work_dir, "copy.mka"), True),
+            ]
+            extract_audio(sample)
+            timings.append(_timed_until_whisper_input(extract_audio, sample))
+            print(f"{fmt:>8} " + " ".join(f"{extracted:>5.2f} / {total:>5.2f}" for extracted, total in timings))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Benchmark di memoria del percorso testuale (trascrizione -> PDF -> prompt di fusione).
+
+Simula lezioni di durata crescente e misura il picco di RSS di ogni esecuzione
+in un processo separato, per ciascun percorso:
+- naive:   vecchia concatenazione di stringhe e prompt costruito con join;
+- mistral: TextBuffer e corpo della richiesta Mistral generato a blocchi;
+- gemini:  TextBuffer e prompt scritto su file temporaneo sopra la soglia dei
+           buffer, come per il caricamento su Gemini.
+Le chiamate di rete non vengono eseguite: il prompt viene generato e scartato.
+
+Uso:
+    python benchmarks/bench_memory.py --hours 1 8 64 512 --spool-mb 1
+"""
+import os
+import sys
+import argparse
+import multiprocessing
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+# Circa 150 parole al minuto, una frase per segmento Whisper
+SEGMENT_TEXT = " In questa parte della lezione analizziamo il teorema e le sue conseguenze principali."
+SEGMENTS_PER_HOUR = 60 * 10
+PAGE_TEXT = "## Slide\n- Definizione formale del concetto\n- Esempio svolto passo per passo\n" * 8
+PAGES_PER_HOUR = 30
+
+def _run_naive(hours):
+    """Percorso originale: concatenazioni ripetute e prompt costruito con join."""
+    transcription = ""
+    for _ in range(int(hours * SEGMENTS_PER_HOUR)):
+        transcription += SEGMENT_TEXT + " "
+    transcription = transcription.strip()
+    extracted_text = ""
+    for _ in range(int(hours * PAGES_PER_HOUR)):
+        extracted_text += PAGE_TEXT + "\n\n"
+    extracted_text = extracted_text.strip()
+    prompt_parts = ["--- Trascrizione Video ---", transcription, "--- Testo PDF ---", extracted_text]
+    final_prompt = "\n".join(prompt_parts)
+    import json
+    body = json.dumps({"messages": [{"role": "user", "content": final_prompt}]}).encode("utf-8")
+    return len(body)
+
+def _run_buffered(hours, provider):
+    """Percorso a TextBuffer fino al prompt di fusione, come in generate_notes_async."""
+    from python_backend.utils.common import TextBuffer
+    from python_backend.ai_fusion import iter_prompt_chunks, _iter_mistral_body, _spool_prompt
+    with TextBuffer() as transcription, TextBuffer() as extracted_text:
+        for _ in range(int(hours * SEGMENTS_PER_HOUR)):
+            transcription.write((" " if transcription else "") + SEGMENT_TEXT.strip())
+        for _ in range(int(hours * PAGES_PER_HOUR)):
+            extracted_text.write(("\n\n" if extracted_text else "") + PAGE_TEXT.strip())
+        if provider == "gemini":
+            # Stringa sotto la soglia, altrimenti file da caricare con genai.upload_file
+            prompt, prompt_path = _spool_prompt(iter_prompt_chunks(transcription, extracted_text))
+            if prompt_path is None:
+                return len(prompt.encode("utf-8"))
+            size = os.path.getsize(prompt_path)
+            os.remove(prompt_path)
+            return size
+        payload = {"messages": [{"role": "user", "content": ""}]}
+        size = 0
+        for block in _iter_mistral_body(payload, iter_prompt_chunks(transcription, extracted_text)):
+            size += len(block)
+        return size
+
+def _worker(mode, hours, spool_mb, queue):
+    os.environ["DEEPNOTES_SPOOL_MB"] = str(spool_mb)
+    from python_backend.utils.common import peak_rss_bytes
+    size = _run_naive(hours) if mode == "naive" else _run_buffered(hours, mode)
+    queue.put((size, peak_rss_bytes() or 0))
+
+def measure(mode, hours, spool_mb):
+    """Esegue una modalità in un processo nuovo e restituisce (byte prompt, picco RSS)."""
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_worker, args=(mode, hours, spool_mb, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark di memoria del percorso testuale di DeepNotes.")
+    parser.add_argument("--hours", type=float, nargs="+", default=[1, 8, 64, 512], help="Durate simulate delle lezioni (ore)")
+    parser.add_argument("--spool-mb", type=float, default=1, help="Soglia RAM dei TextBuffer (DEEPNOTES_SPOOL_MB)")
+    args = parser.parse_args(argv)
+
+    print(f"{'ore':>6} {'prompt MB':>10} {'naive RSS MB':>13} {'mistral RSS MB':>15} {'gemini RSS MB':>14}")
+    for hours in args.hours:
+        size, naive_peak = measure("naive", hours, args.spool_mb)
+        _, mistral_peak = measure("mistral", hours, args.spool_mb)
+        _, gemini_peak = measure("gemini", hours, args.spool_mb)
+        mb = 1024 * 1024
+        print(f"{hours:>6g} {size / mb:>10.1f} {naive_peak / mb:>13.1f} {mistral_peak / mb:>15.1f} {gemini_peak / mb:>14.1f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Benchmark del visualizzatore a pagine delle note.
+
+Per note di dimensione crescente misura:
+- index: costruzione delle righe visualizzate (una sola volta per documento);
+- page:  tempo medio per ottenere una pagina, cioè il lavoro per frame quando si sfoglia;
+- chars: caratteri massimi passati al widget (costante, indipendente dalla lunghezza);
+- save:  salvataggio a blocchi in Markdown.
+
+Uso:
+    python benchmarks/bench_viewer.py --sizes 10000 100000 1000000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, project_root)
+
+from python_backend.notes_document import NotesDocument
+
+def _make_notes(chars):
+    """Note Markdown sintetiche: titoli, elenchi e paragrafi lunghi."""
+    parts = []
+    size = 0
+    section = 0
+    while size < chars:
+        block = (f"## Sezione {section}\n- **Termine {section}**: definizione breve\n"
+                 + "Paragrafo di spiegazione con parole ripetute " * 20 + "\n")
+        parts.append(block)
+        size += len(block)
+        section += 1
+    return "\n".join(parts)[:chars]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del visualizzatore di note di DeepNotes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000, 5_000_000],
+                        help="Dimensioni delle note da provare (caratteri)")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="deepnotes_bench_")
+    try:
+        print(f"{'caratteri':>10} {'pagine':>7} {'index ms':>9} {'page ms':>8} {'chars':>6} {'save ms':>8}")
+        for size in args.sizes:
+            document = NotesDocument(_make_notes(size))
+            start = time.perf_counter()
+            pages = document.page_count()
+            index_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            widest = max(len(document.get_page(page)) for page in range(pages))
+            page_ms = (time.perf_counter() - start) * 1000 / pages
+
+            start = time.perf_counter()
+            document.save(os.path.join(work_dir, "notes.md"))
+            save_ms = (time.perf_counter() - start) * 1000
+            print(f"{size:>10} {pages:>7} {index_ms:>9.1f} {page_ms:>8.3f} {widest:>6} {save_ms:>8.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
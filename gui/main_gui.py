@@ -14,6 +14,12 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 
 from python_backend.main_processor import process_files
+from python_backend.note_index import search_notes, format_results
+from python_backend.sectioned_notes import regenerate_section
+from python_backend.draft_refine import REFINE_MODEL_SIZE, cancel_refinement
+from python_backend.course_notes import load_course, render_course, lecture_identity
+from python_backend.notes_document import NotesDocument, SAVE_FORMATS, DEFAULT_PAGE_LINES
+from python_backend.prefetch import prefetch_video, prefetch_pdf, warm_up_whisper, cancel_prefetch
 
 # Tag costanti per elementi UI
 TAG_VIDEO_PATH_INPUT = "video_path_input"
@@ -27,7 +33,12 @@ TAG_VIDEO_FILE_DIALOG = "video_file_dialog"
 TAG_PDF_FILE_DIALOG = "pdf_file_dialog"
 # Nuovi tag per il salvataggio
 TAG_SAVE_BUTTON = "save_button"
-TAG_SAVE_FILE_DIALOG = "save_file_dialog"
+# Visualizzatore a pagine delle note
+TAG_PAGE_PREV_BUTTON = "page_prev_button"
+TAG_PAGE_NEXT_BUTTON = "page_next_button"
+TAG_PAGE_SLIDER = "page_slider"
+TAG_PAGE_LABEL = "page_label"
+TAG_HEADINGS_COMBO = "headings_combo"
 # Nuovi tag per la configurazione
 TAG_WHISPER_MODEL_COMBO = "whisper_model_combo"
 TAG_GEMINI_API_KEY_INPUT = "gemini_api_key_input"
@@ -38,20 +49,89 @@ TAG_USE_GUI_MISTRAL_KEY_CHECKBOX = "use_gui_mistral_key_checkbox"
 # Nuovi tag per l'indicatore di caricamento e il pulsante copia
 TAG_LOADING_INDICATOR = "loading_indicator"
 TAG_COPY_BUTTON = "copy_button"
+# Tag per la ricerca nelle note indicizzate
+TAG_SEARCH_INPUT = "search_input"
+TAG_SEARCH_BUTTON = "search_button"
+TAG_SEARCH_RESULTS = "search_results"
+# Tag per l'intervallo del video da trascrivere
+TAG_VIDEO_START_INPUT = "video_start_input"
+TAG_VIDEO_END_INPUT = "video_end_input"
+# Tag per la pre-elaborazione speculativa
+TAG_SPECULATIVE_CHECKBOX = "speculative_checkbox"
+# Note a sezioni
+TAG_SECTIONED_CHECKBOX = "sectioned_checkbox"
+TAG_SECTION_INDEX_INPUT = "section_index_input"
+TAG_SECTION_INSTRUCTION_INPUT = "section_instruction_input"
+TAG_REGENERATE_SECTION_BUTTON = "regenerate_section_button"
+TAG_DRAFT_REFINE_CHECKBOX = "draft_refine_checkbox"
+# Corso
+TAG_COURSE_INPUT = "course_input"
+TAG_COURSE_GUIDE_BUTTON = "course_guide_button"
+
+def _parse_time(value):
+    """Converte 'ss', 'mm:ss' o 'hh:mm:ss' in secondi; stringa vuota -> None."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+# Caratteri del log di stato mantenuti nel widget (i messaggi più vecchi vengono scartati)
+MAX_LOG_CHARS = 20000
+
+# Note attualmente visualizzate: copia di riferimento per pagine, salvataggio e copia
+_notes_document = None
+_current_page = 0
+_heading_pages = {}
+# Lezione (lecture_identity) delle note visualizzate: le note affinate di altre lezioni vengono scartate
+_shown_lecture = None
 
 def _log(message):
     """Aggiunge un messaggio all'area di stato/log."""
     current_value = dpg.get_value(TAG_STATUS_TEXT)
-    new_value = f"- {message}\n{current_value}"
+    new_value = f"- {message}\n{current_value}"[:MAX_LOG_CHARS]
     dpg.set_value(TAG_STATUS_TEXT, new_value)
     print(f"LOG: {message}")
 
+def _selected_file(tag):
+    """Percorso del file scelto nel campo indicato, o None se è vuoto, è il testo segnaposto o non esiste."""
+    path = dpg.get_value(tag)
+    return path if path and os.path.isfile(path) else None
+
+def _start_prefetch(kind, file_path):
+    """Se abilitata, avvia la pre-elaborazione del file appena selezionato."""
+    if not dpg.get_value(TAG_SPECULATIVE_CHECKBOX):
+        return
+    try:
+        if kind == 'video':
+            prefetch_video(file_path, dpg.get_value(TAG_WHISPER_MODEL_COMBO))
+        elif kind == 'pdf':
+            prefetch_pdf(file_path)
+    except Exception as e:
+        logger.warning(f"Pre-elaborazione non avviata: {e}")
+
+def whisper_model_changed_callback(sender, app_data):
+    """Carica in anticipo il nuovo modello Whisper se la pre-elaborazione è attiva."""
+    if dpg.get_value(TAG_SPECULATIVE_CHECKBOX):
+        warm_up_whisper(app_data)
+
+def speculative_toggled_callback(sender, app_data):
+    """Avvia o annulla la pre-elaborazione quando la casella viene cambiata."""
+    if app_data:
+        _start_prefetch('video', dpg.get_value(TAG_VIDEO_PATH_INPUT))
+        _start_prefetch('pdf', dpg.get_value(TAG_PDF_PATH_INPUT))
+    else:
+        cancel_prefetch()
+
 def video_file_selected_callback(sender, app_data):
     """Callback eseguita dopo la selezione (o annullamento) del file video."""
     if app_data['selections']:
         file_path = list(app_data['selections'].values())[0]
         _log(f"Video selezionato: {file_path}")
         dpg.set_value(TAG_VIDEO_PATH_INPUT, file_path)
+        _start_prefetch('video', file_path)
     else:
         _log("Selezione video annullata.")
 
@@ -61,23 +141,85 @@ def pdf_file_selected_callback(sender, app_data):
         file_path = list(app_data['selections'].values())[0]
         _log(f"PDF selezionato: {file_path}")
         dpg.set_value(TAG_PDF_PATH_INPUT, file_path)
+        _start_prefetch('pdf', file_path)
     else:
         _log("Selezione PDF annullata.")
 
+def _render_page(page):
+    """Mostra nel widget solo la pagina richiesta delle note (costo costante per frame)."""
+    global _current_page
+    if _notes_document is None:
+        return
+    page_count = _notes_document.page_count(DEFAULT_PAGE_LINES)
+    _current_page = min(max(page, 0), page_count - 1)
+    dpg.set_value(TAG_OUTPUT_TEXT, _notes_document.get_page(_current_page, DEFAULT_PAGE_LINES))
+    dpg.set_value(TAG_PAGE_SLIDER, _current_page + 1)
+    dpg.set_value(TAG_PAGE_LABEL, f"Pagina {_current_page + 1}/{page_count}  ({len(_notes_document):,} caratteri)")
+    dpg.configure_item(TAG_PAGE_PREV_BUTTON, enabled=_current_page > 0)
+    dpg.configure_item(TAG_PAGE_NEXT_BUTTON, enabled=_current_page < page_count - 1)
+
+def _show_notes(content, keep_page=False):
+    """Sostituisce le note visualizzate; il testo completo resta in un NotesDocument."""
+    global _notes_document, _heading_pages
+    _notes_document = NotesDocument(content)
+    page_count = _notes_document.page_count(DEFAULT_PAGE_LINES)
+    dpg.configure_item(TAG_PAGE_SLIDER, max_value=page_count, enabled=page_count > 1)
+    # Indice dei titoli per saltare direttamente a una sezione
+    _heading_pages = {}
+    for n, (paragraph, title) in enumerate(_notes_document.headings(), 1):
+        label = f"{n}. {title.lstrip('#').strip()}"[:70]
+        _heading_pages[label] = _notes_document.page_of_paragraph(paragraph, DEFAULT_PAGE_LINES)
+    dpg.configure_item(TAG_HEADINGS_COMBO, items=list(_heading_pages), enabled=bool(_heading_pages))
+    dpg.set_value(TAG_HEADINGS_COMBO, "")
+    _render_page(_current_page if keep_page else 0)
+
+def _show_message(message):
+    """Mostra un messaggio (es. un errore) al posto delle note."""
+    global _notes_document, _heading_pages
+    _notes_document = None
+    _heading_pages = {}
+    dpg.set_value(TAG_OUTPUT_TEXT, message)
+    dpg.set_value(TAG_PAGE_LABEL, "")
+    dpg.configure_item(TAG_PAGE_SLIDER, max_value=1, enabled=False)
+    dpg.configure_item(TAG_HEADINGS_COMBO, items=[], enabled=False)
+    dpg.configure_item(TAG_PAGE_PREV_BUTTON, enabled=False)
+    dpg.configure_item(TAG_PAGE_NEXT_BUTTON, enabled=False)
+
+def page_step_callback(sender, app_data, user_data):
+    """Pagina precedente (user_data=-1) o successiva (user_data=1)."""
+    _render_page(_current_page + user_data)
+
+def page_slider_callback(sender, app_data):
+    _render_page(app_data - 1)
+
+def heading_selected_callback(sender, app_data):
+    """Salta alla pagina del titolo scelto."""
+    if app_data in _heading_pages:
+        _render_page(_heading_pages[app_data])
+
+def open_native_save_dialog():
+    """Chiede dove salvare le note (Markdown o testo semplice) con il dialog nativo."""
+    import tkinter as tk
+    from tkinter import filedialog
+    root = tk.Tk()
+    root.withdraw()
+    filetypes = [(description, f"*{extension}") for extension, description in SAVE_FORMATS.items()]
+    file_path = filedialog.asksaveasfilename(defaultextension=".md", filetypes=filetypes, initialfile="note.md")
+    root.destroy()
+    file_save_callback(None, {'file_path_name': file_path})
+
 def file_save_callback(sender, app_data):
     """Callback eseguita dopo la selezione del percorso per salvare il file."""
     if app_data['file_path_name']: # Verifica se è stato fornito un percorso
         file_path = app_data['file_path_name']
-        # Assicurati che l'estensione sia .txt (DPG potrebbe non aggiungerla automaticamente)
-        if not file_path.lower().endswith(".txt"):
-            file_path += ".txt"
+        if _notes_document is None:
+            _log("Nessuna nota da salvare.")
+            return
 
         _log(f"Tentativo di salvataggio note in: {file_path}")
         try:
-            # Recupera il contenuto dall'area di output
-            notes_content = dpg.get_value(TAG_OUTPUT_TEXT)
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(notes_content)
+            # Scrittura a blocchi dalla copia completa delle note (non dal widget, che mostra una pagina)
+            file_path = _notes_document.save(file_path)
             _log(f"Note salvate con successo in {file_path}")
         except Exception as e:
             error_message = f"Errore durante il salvataggio del file: {e}"
@@ -95,20 +237,36 @@ def select_pdf_callback():
     dpg.show_item(TAG_PDF_FILE_DIALOG)
 
 def copy_to_clipboard_callback():
-    """Copia il contenuto dell'area output negli appunti del sistema."""
-    notes_content = dpg.get_value(TAG_OUTPUT_TEXT)
+    """Copia le note complete negli appunti del sistema."""
+    if _notes_document is None:
+        _log("Nessuna nota da copiare.")
+        return
     try:
-        pyperclip.copy(notes_content)
+        pyperclip.copy(_notes_document.text)
         _log("Note copiate negli appunti!")
     except Exception as e:
         error_message = f"Errore nella copia negli appunti: {e}"
         logger.error(error_message)
         _log(error_message)
 
+def search_notes_callback(sender=None, app_data=None, user_data=None):
+    """Esegue una ricerca full-text nell'indice locale delle note."""
+    query = dpg.get_value(TAG_SEARCH_INPUT)
+    if not query or not query.strip():
+        dpg.set_value(TAG_SEARCH_RESULTS, "Inserisci un testo da cercare.")
+        return
+    try:
+        results = search_notes(query)
+        dpg.set_value(TAG_SEARCH_RESULTS, format_results(results))
+    except Exception as e:
+        error_message = f"Errore durante la ricerca: {e}"
+        logger.error(error_message)
+        _log(error_message)
+
 def gui_update_callback(status_type, message_or_data):
     """
     Callback per aggiornare la GUI dal thread backend.
-    status_type: 'status', 'warning', 'error', 'debug', 'finish'
+    status_type: 'status', 'warning', 'error', 'debug', 'finish', 'notes'
     message_or_data: stringa del messaggio o dizionario con risultati/errori
     """
     if status_type == "status":
@@ -119,36 +277,63 @@ def gui_update_callback(status_type, message_or_data):
         _log(f"ATTENZIONE: {message_or_data}")
     elif status_type == "error":
         _log(f"ERRORE: {message_or_data}")
-        dpg.set_value(TAG_OUTPUT_TEXT, f"ERRORE DURANTE L'ELABORAZIONE:\n{message_or_data}")
+        _show_message(f"ERRORE DURANTE L'ELABORAZIONE:\n{message_or_data}")
         dpg.configure_item(TAG_SAVE_BUTTON, enabled=False)  # Disabilita salvataggio in caso di errore
         dpg.configure_item(TAG_COPY_BUTTON, enabled=False)  # Disabilita copia in caso di errore
         dpg.hide_item(TAG_LOADING_INDICATOR)  # Nascondi indicatore di caricamento
+    elif status_type == "notes":
+        # Note aggiornate in background (affinamento della bozza), etichettate con la lezione
+        if message_or_data["lecture"] != _shown_lecture:
+            _log("Note affinate di una lezione non più visualizzata: ignorate.")
+            return
+        _show_notes(message_or_data["notes"], keep_page=True)
+        _log("Note aggiornate con la trascrizione affinata.")
     elif status_type == "debug":
         print(f"DEBUG: {message_or_data}")
     elif status_type == "finish":
         _log("Processo terminato (dal backend).")
         if isinstance(message_or_data, dict):
             if "summary" in message_or_data and message_or_data["summary"]:
-                dpg.set_value(TAG_OUTPUT_TEXT, message_or_data["summary"])
+                _show_notes(message_or_data["summary"])
                 dpg.configure_item(TAG_SAVE_BUTTON, enabled=True)  # ABILITA SALVATAGGIO
                 dpg.configure_item(TAG_COPY_BUTTON, enabled=True)  # ABILITA COPIA
             elif "error" in message_or_data:
-                dpg.set_value(TAG_OUTPUT_TEXT, f"PROCESSO FALLITO:\n{message_or_data['error']}")
+                _show_message(f"PROCESSO FALLITO:\n{message_or_data['error']}")
                 dpg.configure_item(TAG_SAVE_BUTTON, enabled=False)  # DISABILITA SALVATAGGIO
                 dpg.configure_item(TAG_COPY_BUTTON, enabled=False)  # DISABILITA COPIA
         else:
             # If message_or_data is a string, assume it's the summary
-            dpg.set_value(TAG_OUTPUT_TEXT, message_or_data)
+            _show_notes(message_or_data)
             dpg.configure_item(TAG_SAVE_BUTTON, enabled=True)
             dpg.configure_item(TAG_COPY_BUTTON, enabled=True)
         dpg.configure_item(TAG_PROCESS_BUTTON, enabled=True)
+        dpg.configure_item(TAG_REGENERATE_SECTION_BUTTON, enabled=True)
         dpg.hide_item(TAG_LOADING_INDICATOR)  # Nascondi indicatore di caricamento
 
+def _read_api_keys():
+    """Legge le API key dalla GUI; restituisce (gemini, mistral) o None se ne manca una richiesta."""
+    gemini_api_key = None
+    mistral_api_key = None
+    
+    if dpg.get_value(TAG_USE_GUI_KEY_CHECKBOX):
+        gemini_api_key = dpg.get_value(TAG_GEMINI_API_KEY_INPUT)
+        if not gemini_api_key:
+            _log("Errore: Inserisci una Gemini API key.")
+            return None
+    
+    if dpg.get_value(TAG_USE_GUI_MISTRAL_KEY_CHECKBOX):
+        mistral_api_key = dpg.get_value(TAG_MISTRAL_API_KEY_INPUT)
+        if not mistral_api_key:
+            _log("Errore: Inserisci una Mistral API key.")
+            return None
+    return gemini_api_key, mistral_api_key
+
 def process_files_callback(sender, app_data, user_data):
     """Callback per il pulsante 'Processa File'."""
+    global _shown_lecture
     # Get file paths
-    video_path = dpg.get_value(TAG_VIDEO_PATH_INPUT)
-    pdf_path = dpg.get_value(TAG_PDF_PATH_INPUT)
+    video_path = _selected_file(TAG_VIDEO_PATH_INPUT)
+    pdf_path = _selected_file(TAG_PDF_PATH_INPUT)
     
     # Validate file paths
     if not video_path and not pdf_path:
@@ -157,28 +342,36 @@ def process_files_callback(sender, app_data, user_data):
     
     # Get Whisper model
     whisper_model = dpg.get_value(TAG_WHISPER_MODEL_COMBO)
+
+    # Get optional video range
+    try:
+        video_start = _parse_time(dpg.get_value(TAG_VIDEO_START_INPUT))
+        video_end = _parse_time(dpg.get_value(TAG_VIDEO_END_INPUT))
+    except ValueError:
+        _log("Errore: Intervallo non valido. Usa il formato mm:ss o hh:mm:ss.")
+        return
+    if video_start is not None and video_end is not None and video_end <= video_start:
+        _log("Errore: La fine dell'intervallo deve seguire l'inizio.")
+        return
     
     # Get API keys
-    use_gui_key = dpg.get_value(TAG_USE_GUI_KEY_CHECKBOX)
-    use_gui_mistral_key = dpg.get_value(TAG_USE_GUI_MISTRAL_KEY_CHECKBOX)
-    
-    gemini_api_key = None
-    mistral_api_key = None
-    
-    if use_gui_key:
-        gemini_api_key = dpg.get_value(TAG_GEMINI_API_KEY_INPUT)
-        if not gemini_api_key:
-            _log("Errore: Inserisci una Gemini API key.")
-            return
-    
-    if use_gui_mistral_key:
-        mistral_api_key = dpg.get_value(TAG_MISTRAL_API_KEY_INPUT)
-        if not mistral_api_key:
-            _log("Errore: Inserisci una Mistral API key.")
-            return
+    api_keys = _read_api_keys()
+    if api_keys is None:
+        return
+    gemini_api_key, mistral_api_key = api_keys
+    sectioned = dpg.get_value(TAG_SECTIONED_CHECKBOX)
+    refine_model = REFINE_MODEL_SIZE if dpg.get_value(TAG_DRAFT_REFINE_CHECKBOX) else None
+    course = dpg.get_value(TAG_COURSE_INPUT).strip() or None
+
+    # Un affinamento ancora in corso della stessa lezione riguarda note che stanno per essere
+    # sostituite; quelli delle altre lezioni proseguono e ne aggiornano il corso
+    if video_path:
+        cancel_refinement(video_path, pdf_path)
+    _shown_lecture = lecture_identity(video_path, pdf_path)[0]
     
     # Disable buttons during processing
     dpg.configure_item(TAG_PROCESS_BUTTON, enabled=False)
+    dpg.configure_item(TAG_REGENERATE_SECTION_BUTTON, enabled=False)
     dpg.configure_item(TAG_SAVE_BUTTON, enabled=False)
     dpg.configure_item(TAG_COPY_BUTTON, enabled=False)
     
@@ -191,16 +384,22 @@ def process_files_callback(sender, app_data, user_data):
     
     # Avvia thread per elaborazione
     thread = threading.Thread(
-        target=lambda: process_files_thread(video_path, pdf_path, whisper_model, gemini_api_key, mistral_api_key)
+        target=lambda: process_files_thread(video_path, pdf_path, whisper_model, gemini_api_key, mistral_api_key,
+                                            video_start, video_end, sectioned, refine_model, course)
     )
     thread.daemon = True
     thread.start()
 
-def process_files_thread(video_path, pdf_path, whisper_model, gemini_api_key, mistral_api_key):
+def process_files_thread(video_path, pdf_path, whisper_model, gemini_api_key, mistral_api_key, video_start=None, video_end=None,
+                         sectioned=False, refine_model=None, course=None):
     """Esegue l'elaborazione files in un thread separato per non bloccare la GUI."""
+    lecture_id = lecture_identity(video_path, pdf_path)[0]
     try:
         # Process files
-        result = process_files(video_path, pdf_path, whisper_model, gemini_api_key, mistral_api_key, gui_update_callback)
+        result = process_files(video_path, pdf_path, whisper_model, gemini_api_key, mistral_api_key, gui_update_callback,
+                               video_start=video_start, video_end=video_end, sectioned=sectioned, refine_model=refine_model,
+                               notes_callback=lambda notes: gui_update_callback("notes", {"lecture": lecture_id, "notes": notes}),
+                               course=course)
         
         # Update output attraverso il callback
         if result:
@@ -211,6 +410,66 @@ def process_files_thread(video_path, pdf_path, whisper_model, gemini_api_key, mi
         logger.error(error_message)
         gui_update_callback("error", error_message)
 
+def course_guide_callback(sender=None, app_data=None, user_data=None):
+    """Mostra la guida di studio (riassunto e glossario) del corso indicato."""
+    global _shown_lecture
+    course = dpg.get_value(TAG_COURSE_INPUT).strip()
+    if not course:
+        _log("Errore: Inserisci il nome del corso.")
+        return
+    try:
+        state = load_course(course)
+    except Exception as e:
+        error_message = f"Errore nella lettura del corso: {e}"
+        logger.error(error_message)
+        _log(error_message)
+        return
+    if not state["lectures"]:
+        _log(f"Il corso '{course}' non contiene ancora lezioni.")
+        return
+    _shown_lecture = None
+    _show_notes(render_course(state))
+    dpg.configure_item(TAG_SAVE_BUTTON, enabled=True)
+    dpg.configure_item(TAG_COPY_BUTTON, enabled=True)
+    _log(f"Guida del corso '{course}' ({len(state['lectures'])} lezioni).")
+
+def regenerate_section_callback(sender=None, app_data=None, user_data=None):
+    """Rigenera una sola sezione delle note della lezione selezionata."""
+    global _shown_lecture
+    video_path = _selected_file(TAG_VIDEO_PATH_INPUT)
+    pdf_path = _selected_file(TAG_PDF_PATH_INPUT)
+    if not video_path and not pdf_path:
+        _log("Errore: Seleziona il video e/o il PDF della lezione già elaborata.")
+        return
+    api_keys = _read_api_keys()
+    if api_keys is None:
+        return
+    # Nella GUI le sezioni sono numerate da 1
+    section_index = dpg.get_value(TAG_SECTION_INDEX_INPUT) - 1
+    instruction = dpg.get_value(TAG_SECTION_INSTRUCTION_INPUT).strip() or None
+    _shown_lecture = lecture_identity(video_path, pdf_path)[0]
+
+    dpg.configure_item(TAG_PROCESS_BUTTON, enabled=False)
+    dpg.configure_item(TAG_REGENERATE_SECTION_BUTTON, enabled=False)
+    dpg.show_item(TAG_LOADING_INDICATOR)
+    dpg.configure_item(TAG_LOADING_INDICATOR, label=f"Rigenerazione sezione {section_index + 1}...")
+    _log(f"Rigenerazione della sezione {section_index + 1}...")
+
+    def run():
+        try:
+            notes = regenerate_section(video_path, pdf_path, section_index, instruction, *api_keys,
+                                       update_callback=gui_update_callback)
+            if notes:
+                gui_update_callback("finish", notes)
+            else:
+                gui_update_callback("finish", {"error": "Rigenerazione della sezione non riuscita."})
+        except Exception as e:
+            error_message = f"Errore: {str(e)}"
+            logger.error(error_message)
+            gui_update_callback("error", error_message)
+
+    threading.Thread(target=run, daemon=True).start()
+
 # === THEME & STYLE ===
 def setup_modern_theme():
     with dpg.theme() as global_theme:
@@ -291,6 +550,7 @@ def drag_drop_file_callback(sender, app_data, user_data):
     elif user_data == 'pdf':
         dpg.set_value(TAG_PDF_PATH_INPUT, file_path)
         _log(f"PDF trascinato: {file_path}")
+    _start_prefetch(user_data, file_path)
 
 # === FILE PICKER NATIVO ===
 def open_native_file_picker(filetype, user_data):
@@ -311,6 +571,7 @@ def open_native_file_picker(filetype, user_data):
         elif user_data == 'pdf':
             dpg.set_value(TAG_PDF_PATH_INPUT, file_path)
             _log(f"PDF selezionato: {file_path}")
+        _start_prefetch(user_data, file_path)
 
 def create_main_window():
     setup_modern_theme()
@@ -333,6 +594,10 @@ def create_main_window():
         with dpg.group(horizontal=True):
             dpg.add_button(label="Scegli Video", width=150, callback=lambda: open_native_file_picker('video', 'video'))
             dpg.add_input_text(tag=TAG_VIDEO_PATH_INPUT, readonly=True, width=420, default_value="Trascina qui il percorso o scegli un file video")
+        with dpg.group(horizontal=True):
+            dpg.add_input_text(tag=TAG_VIDEO_START_INPUT, hint="Inizio (mm:ss)", width=150)
+            dpg.add_input_text(tag=TAG_VIDEO_END_INPUT, hint="Fine (mm:ss)", width=150)
+            dpg.add_text("Intervallo opzionale da trascrivere", color=(120, 120, 120, 255))
         dpg.add_spacer(height=8)
         # --- ZONA FILE PDF ---
         dpg.add_text("2. Carica un PDF (slide o testo)", color=(33, 33, 33, 255), bullet=True)
@@ -343,7 +608,11 @@ def create_main_window():
         # --- MODELLO WHISPER ---
         dpg.add_text("3. Modello Trascrizione", color=(33, 33, 33, 255), bullet=True)
         whisper_models = ["tiny", "base", "small", "medium", "large-v3"]
-        dpg.add_combo(items=whisper_models, default_value="base", tag=TAG_WHISPER_MODEL_COMBO, width=180)
+        dpg.add_combo(items=whisper_models, default_value="base", tag=TAG_WHISPER_MODEL_COMBO, width=180, callback=whisper_model_changed_callback)
+        dpg.add_checkbox(label="Pre-elabora i file appena selezionati (audio, PDF, modello)", tag=TAG_SPECULATIVE_CHECKBOX, default_value=False, callback=speculative_toggled_callback)
+        dpg.add_input_text(tag=TAG_COURSE_INPUT, hint="Corso (opzionale): integra le note nel riassunto del corso", width=420)
+        dpg.add_checkbox(label=f"Bozza rapida con il modello scelto, poi affinamento con {REFINE_MODEL_SIZE} in background", tag=TAG_DRAFT_REFINE_CHECKBOX, default_value=False)
+        dpg.add_checkbox(label="Note a sezioni (alle nuove elaborazioni rigenera solo le parti cambiate)", tag=TAG_SECTIONED_CHECKBOX, default_value=False)
         dpg.add_spacer(height=16)
         dpg.add_separator()
         dpg.add_spacer(height=10)
@@ -362,11 +631,33 @@ def create_main_window():
         dpg.add_spacer(height=10)
         # --- NOTE GENERATE ---
         dpg.add_text("Note Generate", color=(33, 33, 33, 255), wrap=0)
+        # Il widget contiene solo la pagina visibile: il testo completo resta in _notes_document
         dpg.add_input_text(tag=TAG_OUTPUT_TEXT, multiline=True, readonly=True, default_value="L'output apparirà qui...", width=-1, height=220)
+        with dpg.group(horizontal=True):
+            dpg.add_button(label="◀", tag=TAG_PAGE_PREV_BUTTON, callback=page_step_callback, user_data=-1, enabled=False, width=40)
+            dpg.add_slider_int(tag=TAG_PAGE_SLIDER, default_value=1, min_value=1, max_value=1, width=200, enabled=False, callback=page_slider_callback)
+            dpg.add_button(label="▶", tag=TAG_PAGE_NEXT_BUTTON, callback=page_step_callback, user_data=1, enabled=False, width=40)
+            dpg.add_combo(tag=TAG_HEADINGS_COMBO, items=[], width=250, enabled=False, callback=heading_selected_callback)
+        dpg.add_text("", tag=TAG_PAGE_LABEL, color=(120, 120, 120, 255))
         dpg.add_spacer(height=10)
         with dpg.group(horizontal=True):
-            dpg.add_button(label="💾 Salva Note", tag=TAG_SAVE_BUTTON, callback=lambda: dpg.show_item(TAG_SAVE_FILE_DIALOG), enabled=False, width=200)
+            dpg.add_button(label="💾 Salva Note", tag=TAG_SAVE_BUTTON, callback=open_native_save_dialog, enabled=False, width=200)
             dpg.add_button(label="📋 Copia negli Appunti", tag=TAG_COPY_BUTTON, callback=copy_to_clipboard_callback, enabled=False, width=200)
+            dpg.add_button(label="📚 Guida del Corso", tag=TAG_COURSE_GUIDE_BUTTON, callback=course_guide_callback, width=200)
+        dpg.add_spacer(height=4)
+        with dpg.group(horizontal=True):
+            dpg.add_input_int(tag=TAG_SECTION_INDEX_INPUT, default_value=1, min_value=1, min_clamped=True, width=100)
+            dpg.add_input_text(tag=TAG_SECTION_INSTRUCTION_INPUT, hint="Richiesta per la sezione (es. più esempi)", width=300)
+            dpg.add_button(label="🔄 Rigenera Sezione", tag=TAG_REGENERATE_SECTION_BUTTON, callback=regenerate_section_callback, width=200)
+        dpg.add_spacer(height=16)
+        dpg.add_separator()
+        dpg.add_spacer(height=10)
+        # --- RICERCA NELLE NOTE ---
+        dpg.add_text("Cerca nelle Lezioni", color=(33, 33, 33, 255), wrap=0)
+        with dpg.group(horizontal=True):
+            dpg.add_input_text(tag=TAG_SEARCH_INPUT, hint="Cerca in note, trascrizioni e PDF...", width=420, on_enter=True, callback=search_notes_callback)
+            dpg.add_button(label="🔍 Cerca", tag=TAG_SEARCH_BUTTON, callback=search_notes_callback, width=150)
+        dpg.add_input_text(tag=TAG_SEARCH_RESULTS, multiline=True, readonly=True, default_value="", width=-1, height=140)
         dpg.add_spacer(height=16)
         dpg.add_separator()
         dpg.add_spacer(height=10)
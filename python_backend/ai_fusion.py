@@ -1,27 +1,228 @@
 import time
 import os
+import json
+import asyncio
 import logging
+import tempfile
+import threading
 import google.generativeai as genai
-import requests
+from google.ai import generativelanguage as glm
+import httpx
+from .utils.common import iter_text_chunks, get_spool_max_bytes, memory_ceiling_exceeded
+from .rate_limiter import (
+    call_with_rate_limit_async, estimate_tokens, RateLimitedError,
+    PROVIDER_GEMINI, PROVIDER_MISTRAL, PRIORITY_INTERACTIVE
+)
 
 # Configurazione di base del logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def merge_and_summarize(video_text, pdf_text, gemini_api_key=None, mistral_api_key=None, update_callback=None):
+# Istruzioni iniziali del prompt di fusione
+PROMPT_HEADER = [
+    "Sei un assistente esperto nella creazione di appunti di lezione dettagliati e ben organizzati.",
+    "Il tuo compito è sintetizzare le informazioni provenienti da una trascrizione video e/o da un documento PDF (slide/testo) per creare note complete.",
+    "Struttura le note utilizzando Markdown per chiarezza (titoli, elenchi puntati, grassetto per termini chiave).",
+    "Fondi le informazioni in modo coerente, non limitarti a riassumere le fonti separatamente.",
+    "Se una fonte manca, basa le note solo su quella disponibile.",
+    "Evita frasi come 'Basandomi sul video...' o 'Dal PDF emerge che...'. Presenta direttamente le informazioni.",
+    "\n--- INIZIO CONTENUTO ---\n"
+]
+
+def iter_prompt_chunks(video_text, pdf_text):
+    """
+    Genera il prompt di fusione a blocchi, senza mai costruirlo per intero.
+    video_text e pdf_text possono essere stringhe o TextBuffer.
+    """
+    yield "\n".join(PROMPT_HEADER)
+    if video_text:
+        yield "\n--- Trascrizione Video ---\n"
+        yield from iter_text_chunks(video_text)
+        yield "\n--- Fine Trascrizione Video ---\n"
+    if pdf_text:
+        yield "\n--- Testo PDF ---\n"
+        yield from iter_text_chunks(pdf_text)
+        yield "\n--- Fine Testo PDF ---\n"
+    yield "\n--- FINE CONTENUTO ---\n"
+    yield "\nGenera ora le note di lezione dettagliate:"
+
+# Istruzioni per la generazione di una singola sezione delle note
+SECTION_PROMPT_HEADER = [
+    "Sei un assistente esperto nella creazione di appunti di lezione dettagliati e ben organizzati.",
+    "Stai scrivendo UNA SOLA sezione di appunti più lunghi, basata sulla parte di lezione e sulle slide riportate sotto.",
+    "Inizia con un titolo Markdown di secondo livello (##) che descriva l'argomento della sezione.",
+    "Usa elenchi puntati e grassetto per i termini chiave; non aggiungere introduzioni o conclusioni generali.",
+    "Evita frasi come 'Basandomi sul video...' o 'Dal PDF emerge che...'. Presenta direttamente le informazioni.",
+]
+
+def iter_section_prompt_chunks(transcript_text, pdf_text, instruction=None, previous_notes=None):
+    """Genera il prompt per una singola sezione (testi brevi, già limitati alla sezione)."""
+    yield "\n".join(SECTION_PROMPT_HEADER)
+    if instruction:
+        yield f"\nRichiesta specifica per questa sezione: {instruction}\n"
+        if previous_notes:
+            yield "\n--- Versione attuale della sezione ---\n"
+            yield previous_notes
+            yield "\n--- Fine versione attuale ---\n"
+    yield "\n--- INIZIO CONTENUTO ---\n"
+    if transcript_text:
+        yield "\n--- Trascrizione Video ---\n"
+        yield transcript_text
+        yield "\n--- Fine Trascrizione Video ---\n"
+    if pdf_text:
+        yield "\n--- Testo PDF ---\n"
+        yield pdf_text
+        yield "\n--- Fine Testo PDF ---\n"
+    yield "\n--- FINE CONTENUTO ---\n"
+    yield "\nGenera ora la sezione di appunti:"
+
+# Istruzioni per l'aggiornamento del riassunto di corso con una nuova lezione
+COURSE_PROMPT_HEADER = [
+    "Sei un assistente esperto nella preparazione di guide di studio universitarie.",
+    "Ricevi il riassunto attuale di un corso, il suo glossario e gli appunti di una nuova lezione.",
+    "Aggiorna il riassunto integrando la nuova lezione nella struttura esistente (non accodarla in fondo) e aggiorna il glossario con i nuovi termini.",
+    "Il riassunto deve restare in Markdown e non superare {max_words} parole: condensa le parti meno importanti se necessario.",
+    "Il glossario deve contenere al massimo {max_terms} termini, una riga per termine nel formato '- **Termine**: definizione breve'.",
+    "Rispondi solo con le due parti, ciascuna preceduta dalla propria intestazione esattamente come indicato:",
+    "=== RIASSUNTO DEL CORSO ===",
+    "=== GLOSSARIO ===",
+]
+
+def iter_course_prompt_chunks(course_name, summary, glossary, lecture_title, lecture_notes, max_words, max_terms):
+    """Genera il prompt di aggiornamento del corso (tutte le parti hanno dimensione limitata)."""
+    yield "\n".join(COURSE_PROMPT_HEADER).format(max_words=max_words, max_terms=max_terms)
+    yield f"\n\nCorso: {course_name}\n"
+    yield "\n--- Riassunto attuale del corso ---\n"
+    yield summary or "(vuoto: questa è la prima lezione)"
+    yield "\n--- Glossario attuale ---\n"
+    yield "\n".join(f"- **{term}**: {definition}" for term, definition in glossary.items()) or "(vuoto)"
+    yield f"\n--- Appunti della nuova lezione: {lecture_title} ---\n"
+    yield lecture_notes
+    yield "\n--- Fine appunti ---\n"
+    yield "\nGenera ora il riassunto aggiornato e il glossario:"
+
+def _iter_mistral_body(payload, prompt_chunks):
+    """
+    Serializza il corpo JSON della richiesta Mistral a blocchi (trasferimento chunked),
+    inserendo il prompt come contenuto dell'ultimo messaggio.
+    """
+    placeholder = "__DEEPNOTES_PROMPT__"
+    payload["messages"][-1]["content"] = placeholder
+    prefix, suffix = json.dumps(payload).split(json.dumps(placeholder), 1)
+    yield (prefix + '"').encode("utf-8")
+    for chunk in prompt_chunks:
+        # json.dumps gestisce escape e caratteri non ASCII; si rimuovono le virgolette esterne
+        yield json.dumps(chunk)[1:-1].encode("utf-8")
+    yield ('"' + suffix).encode("utf-8")
+
+async def _aiter_blocks(blocks):
+    """Adatta un generatore sincrono di byte al corpo asincrono di httpx."""
+    for block in blocks:
+        yield block
+
+# genai.configure è globale al processo: le chiamate sincrone ai file Gemini
+# (upload/eliminazione) configurano la propria chiave sotto questo lock
+_gemini_files_lock = threading.Lock()
+
+def _gemini_model(api_key):
+    """
+    Modello Gemini con un client asincrono proprio, legato ad api_key.
+    Il client predefinito dell'SDK userebbe la chiave dell'ultimo genai.configure,
+    anche di un altro job, e verrebbe creato solo dopo l'attesa nello scheduler.
+    """
+    model = genai.GenerativeModel('gemini-2.5-pro-exp-03-25')
+    model._async_client = glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+    return model
+
+def _call_gemini_files(api_key, fn, *args, **kwargs):
+    """Esegue una funzione sincrona dei file Gemini (es. genai.upload_file) con api_key."""
+    with _gemini_files_lock:
+        genai.configure(api_key=api_key)
+        return fn(*args, **kwargs)
+
+# Messaggio che accompagna il prompt quando viene inviato a Gemini come file allegato
+GEMINI_FILE_INSTRUCTION = "Il file allegato contiene le istruzioni e il contenuto della lezione: seguile e genera le note richieste."
+
+def _spool_prompt(prompt_chunks):
+    """
+    Accumula il prompt in memoria finché resta sotto la soglia dei TextBuffer
+    (o subito su disco se il tetto RSS è superato).
+
+    Returns:
+        (prompt, None) se il prompt sta in memoria, altrimenti (None, percorso di un
+        file temporaneo con il prompt completo, da eliminare dopo l'uso).
+    """
+    max_memory_bytes = 0 if memory_ceiling_exceeded() else get_spool_max_bytes()
+    chunks = iter(prompt_chunks)
+    parts = []
+    size = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        if size > max_memory_bytes:
+            f = tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False)
+            try:
+                with f:
+                    f.writelines(parts)
+                    parts = None
+                    for chunk in chunks:
+                        f.write(chunk)
+            except BaseException:
+                os.remove(f.name)
+                raise
+            return None, f.name
+    return "".join(parts), None
+
+def merge_and_summarize(video_text, pdf_text, gemini_api_key=None, mistral_api_key=None, update_callback=None,
+                        priority=PRIORITY_INTERACTIVE):
     """
     Invia i testi estratti a Google Gemini API o Mistral API per generare note di lezione strutturate.
+    Wrapper sincrono di merge_and_summarize_async (stessi argomenti e valore di ritorno).
+    """
+    return asyncio.run(merge_and_summarize_async(
+        video_text, pdf_text, gemini_api_key, mistral_api_key, update_callback, priority=priority
+    ))
+
+async def merge_and_summarize_async(video_text, pdf_text, gemini_api_key=None, mistral_api_key=None, update_callback=None,
+                                    priority=PRIORITY_INTERACTIVE):
+    """
+    Variante asyncio di merge_and_summarize: usa il client asincrono di Gemini e
+    HTTP asincrono per Mistral, così più fusioni possono girare sullo stesso event loop.
     
     Args:
-        video_text: Testo trascritto dal video (può essere None).
-        pdf_text: Testo estratto dal PDF (può essere None).
+        video_text: Testo trascritto dal video, str o TextBuffer (può essere None).
+        pdf_text: Testo estratto dal PDF, str o TextBuffer (può essere None).
         gemini_api_key: Chiave API per Google Gemini (opzionale).
         mistral_api_key: Chiave API per Mistral (opzionale).
         update_callback: Funzione callback per aggiornare lo stato nell'UI.
+        priority: Priorità delle chiamate nello scheduler dei limiti (interattiva o batch).
         
     Returns:
         Testo delle note generate o None in caso di errore.
     """
+    return await generate_notes_async(
+        lambda: iter_prompt_chunks(video_text, pdf_text), estimate_tokens(video_text, pdf_text),
+        gemini_api_key, mistral_api_key, update_callback, priority=priority
+    )
+
+async def generate_notes_async(prompt_factory, prompt_tokens, gemini_api_key=None, mistral_api_key=None, update_callback=None,
+                               priority=PRIORITY_INTERACTIVE, max_tokens=4000):
+    """
+    Invia un prompt a Gemini e, se non disponibile o in errore, a Mistral.
+
+    Args:
+        prompt_factory: Funzione senza argomenti che restituisce il prompt a blocchi
+            (richiamata a ogni tentativo, così il prompt non resta in memoria).
+        prompt_tokens: Token stimati del prompt, per i limiti token/minuto.
+        gemini_api_key: Chiave API per Google Gemini (opzionale).
+        mistral_api_key: Chiave API per Mistral (opzionale).
+        update_callback: Funzione callback per aggiornare lo stato nell'UI.
+        priority: Priorità delle chiamate nello scheduler dei limiti (interattiva o batch).
+        max_tokens: Lunghezza massima della risposta Mistral.
+
+    Returns:
+        Testo generato o None in caso di errore.
+    """
     try:
         # Helper function to handle updates with or without callback
         def log_update(status_type, message):
@@ -62,41 +263,36 @@ def merge_and_summarize(video_text, pdf_text, gemini_api_key=None, mistral_api_k
             log_update("error", error_message)
             return None
             
-        # Costruisci il prompt
-        prompt_parts = [
-            "Sei un assistente esperto nella creazione di appunti di lezione dettagliati e ben organizzati.",
-            "Il tuo compito è sintetizzare le informazioni provenienti da una trascrizione video e/o da un documento PDF (slide/testo) per creare note complete.",
-            "Struttura le note utilizzando Markdown per chiarezza (titoli, elenchi puntati, grassetto per termini chiave).",
-            "Fondi le informazioni in modo coerente, non limitarti a riassumere le fonti separatamente.",
-            "Se una fonte manca, basa le note solo su quella disponibile.",
-            "Evita frasi come 'Basandomi sul video...' o 'Dal PDF emerge che...'. Presenta direttamente le informazioni.",
-            "\n--- INIZIO CONTENUTO ---\n"
-        ]
-        
-        if video_text:
-            prompt_parts.append("--- Trascrizione Video ---")
-            prompt_parts.append(video_text)
-            prompt_parts.append("--- Fine Trascrizione Video ---\n")
-            
-        if pdf_text:
-            prompt_parts.append("--- Testo PDF ---")
-            prompt_parts.append(pdf_text)
-            prompt_parts.append("--- Fine Testo PDF ---\n")
-            
-        prompt_parts.append("--- FINE CONTENUTO ---\n")
-        prompt_parts.append("Genera ora le note di lezione dettagliate:")
-        
-        final_prompt = "\n".join(prompt_parts)
-        
         # Prova prima con Gemini se disponibile
         if gemini_key:
             try:
                 log_update("status", f"Connessione a Google Gemini (usando key da {using_gemini_source})...")
-                genai.configure(api_key=gemini_key)
-                model = genai.GenerativeModel('gemini-2.5-pro-exp-03-25')
+                model = _gemini_model(gemini_key)
                 
                 log_update("status", "Invio richiesta a Gemini e generazione note (potrebbe richiedere tempo)...")
-                response = model.generate_content(final_prompt)
+                async def send_to_gemini():
+                    # Sotto la soglia dei buffer il prompt va come stringa; sopra viene scritto
+                    # su disco e caricato come file, così non è mai interamente in memoria
+                    prompt, prompt_path = await asyncio.to_thread(_spool_prompt, prompt_factory())
+                    if prompt_path is None:
+                        return await model.generate_content_async(prompt)
+                    uploaded = None
+                    try:
+                        uploaded = await asyncio.to_thread(_call_gemini_files, gemini_key, genai.upload_file,
+                                                           prompt_path, mime_type="text/plain")
+                        return await model.generate_content_async([uploaded, GEMINI_FILE_INSTRUCTION])
+                    finally:
+                        os.remove(prompt_path)
+                        if uploaded is not None:
+                            try:
+                                await asyncio.to_thread(_call_gemini_files, gemini_key, genai.delete_file, uploaded.name)
+                            except Exception as delete_error:
+                                logger.warning(f"Impossibile eliminare il prompt caricato su Gemini: {delete_error}")
+
+                response = await call_with_rate_limit_async(
+                    PROVIDER_GEMINI, gemini_key, send_to_gemini,
+                    tokens=prompt_tokens, priority=priority, update_callback=update_callback
+                )
                 
                 # Gestisci la risposta
                 if hasattr(response, 'prompt_feedback') and response.prompt_feedback and response.prompt_feedback.block_reason:
@@ -134,17 +330,32 @@ def merge_and_summarize(video_text, pdf_text, gemini_api_key=None, mistral_api_k
                     "model": "mistral-medium",
                     "messages": [
                         {"role": "system", "content": "Sei un assistente esperto nella creazione di appunti di lezione dettagliati e ben organizzati."},
-                        {"role": "user", "content": final_prompt}
+                        {"role": "user", "content": ""}
                     ],
                     "temperature": 0.7,
-                    "max_tokens": 4000
+                    "max_tokens": max_tokens
                 }
                 
                 log_update("status", "Invio richiesta a Mistral e generazione note (potrebbe richiedere tempo)...")
-                response = requests.post(
-                    "https://api.mistral.ai/v1/chat/completions",
-                    headers=headers,
-                    json=data
+                async def post_to_mistral():
+                    # Il corpo viene inviato a blocchi: il prompt completo non è mai in memoria
+                    async with httpx.AsyncClient(timeout=None) as client:
+                        response = await client.post(
+                            "https://api.mistral.ai/v1/chat/completions",
+                            headers=headers,
+                            content=_aiter_blocks(_iter_mistral_body(data, prompt_factory()))
+                        )
+                    if response.status_code == 429:
+                        retry_after = response.headers.get("Retry-After")
+                        raise RateLimitedError(
+                            f"Quota Mistral superata: {response.text}",
+                            float(retry_after) if retry_after and retry_after.isdigit() else None
+                        )
+                    return response
+
+                response = await call_with_rate_limit_async(
+                    PROVIDER_MISTRAL, mistral_key, post_to_mistral,
+                    tokens=prompt_tokens + data["max_tokens"], priority=priority, update_callback=update_callback
                 )
                 
                 if response.status_code == 200:
@@ -177,3 +388,38 @@ def merge_and_summarize(video_text, pdf_text, gemini_api_key=None, mistral_api_k
         logger.error(error_message)
         log_update("error", error_message)
         return None
+
+async def summarize_section_async(transcript_text, pdf_text, gemini_api_key=None, mistral_api_key=None, update_callback=None,
+                                  priority=PRIORITY_INTERACTIVE, instruction=None, previous_notes=None):
+    """
+    Genera le note di una sola sezione con una chiamata breve.
+
+    Args:
+        transcript_text: Trascrizione della parte di lezione coperta dalla sezione.
+        pdf_text: Testo delle pagine PDF associate alla sezione.
+        instruction: Richiesta dell'utente (es. "riscrivi in modo più sintetico"), opzionale.
+        previous_notes: Testo attuale della sezione, usato insieme a instruction.
+
+    Returns:
+        Markdown della sezione o None in caso di errore.
+    """
+    return await generate_notes_async(
+        lambda: iter_section_prompt_chunks(transcript_text, pdf_text, instruction, previous_notes),
+        estimate_tokens(transcript_text, pdf_text, previous_notes),
+        gemini_api_key, mistral_api_key, update_callback, priority=priority, max_tokens=1500
+    )
+
+async def merge_course_async(course_name, summary, glossary, lecture_title, lecture_notes, max_words, max_terms,
+                             gemini_api_key=None, mistral_api_key=None, update_callback=None, priority=PRIORITY_INTERACTIVE):
+    """
+    Integra una lezione nel riassunto e nel glossario di un corso con una sola chiamata.
+
+    Returns:
+        Risposta grezza del modello (riassunto e glossario con le intestazioni) o None in caso di errore.
+    """
+    glossary_text = " ".join(f"{term} {definition}" for term, definition in glossary.items())
+    return await generate_notes_async(
+        lambda: iter_course_prompt_chunks(course_name, summary, glossary, lecture_title, lecture_notes, max_words, max_terms),
+        estimate_tokens(summary, glossary_text, lecture_notes),
+        gemini_api_key, mistral_api_key, update_callback, priority=priority, max_tokens=8000
+    )
@@ -0,0 +1,308 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import argparse
+import threading
+from .ai_fusion import merge_course_async
+from .utils.common import get_cache_dir, file_fingerprint, hold_lock, text_value
+from .rate_limiter import PRIORITY_INTERACTIVE
+
+# Configurazione di base del logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Limiti del riassunto di corso: il costo di ogni nuova lezione resta costante
+MAX_SUMMARY_WORDS = 1500
+MAX_SUMMARY_CHARS = 15000
+MAX_GLOSSARY_TERMS = 120
+MAX_DEFINITION_CHARS = 300
+# Caratteri degli appunti di una lezione inviati nel passo di fusione
+MAX_LECTURE_CHARS = 40000
+STATE_VERSION = 1
+
+SUMMARY_MARKER = "=== RIASSUNTO DEL CORSO ==="
+GLOSSARY_MARKER = "=== GLOSSARIO ==="
+_GLOSSARY_LINE = re.compile(r"^\s*[-*]\s*\*\*(.+?)\*\*\s*[:–—-]\s*(.+?)\s*$")
+_HEADING_LINE = re.compile(r"^#{1,6}\s", re.MULTILINE)
+
+_locks_guard = threading.Lock()
+_course_locks = {}
+
+def _course_lock(course_name):
+    """Lock per corso: due lezioni dello stesso corso non vengono fuse contemporaneamente."""
+    with _locks_guard:
+        return _course_locks.setdefault(course_name.strip().lower(), threading.Lock())
+
+def _course_path(course_name):
+    slug = re.sub(r"[^a-z0-9]+", "-", course_name.strip().lower()).strip("-")[:40] or "corso"
+    digest = hashlib.sha256(course_name.strip().lower().encode("utf-8")).hexdigest()[:8]
+    return os.path.join(get_cache_dir("courses"), f"{slug}-{digest}.json")
+
+def load_course(course_name):
+    """Restituisce lo stato del corso (riassunto, glossario, lezioni incluse); vuoto se nuovo."""
+    path = _course_path(course_name)
+    if os.path.exists(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("version") == STATE_VERSION:
+                return state
+        except (OSError, ValueError) as e:
+            logger.warning(f"Stato del corso illeggibile ({path}): {e}")
+    return {"version": STATE_VERSION, "name": course_name.strip(), "summary": "", "glossary": {}, "glossary_added": {},
+            "lectures": []}
+
+def _save_course(state):
+    """Salva lo stato del corso con rinomina atomica."""
+    path = _course_path(state["name"])
+    part_path = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        with open(part_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=1)
+        os.replace(part_path, path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+def _truncate(text, max_chars):
+    """Taglia il testo a max_chars, preferibilmente a fine paragrafo o parola."""
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind("\n\n", 0, max_chars)
+    if cut < max_chars // 2:
+        cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > 0 else max_chars].rstrip()
+
+def _condense_section(section, max_chars):
+    """Titolo e prime righe (punti elenco, paragrafi) di una sezione, entro max_chars."""
+    if len(section) <= max_chars:
+        return section
+    kept = []
+    size = 0
+    for line in section.split("\n"):
+        room = max_chars - size - (1 if kept else 0)
+        if len(line) > room:
+            # Una riga lunga si accorcia solo se altrimenti resterebbe il solo titolo
+            if len(kept) <= 1 and room > 0:
+                kept.append(_truncate(line, room))
+            break
+        kept.append(line)
+        size += len(line) + (1 if len(kept) > 1 else 0)
+    return "\n".join(kept).rstrip()
+
+def _condense_notes(notes, max_chars):
+    """
+    Riduce le note a max_chars senza perdere la fine della lezione: ogni sezione
+    Markdown riceve una quota uguale del limite (le sezioni brevi restano intere e
+    cedono il resto alle altre) e di quelle lunghe si tengono titolo e prime righe.
+    """
+    if len(notes) <= max_chars:
+        return notes
+    starts = [match.start() for match in _HEADING_LINE.finditer(notes)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    sections = [notes[start:end].strip("\n") for start, end in zip(starts, starts[1:] + [len(notes)])]
+    sections = [section for section in sections if section.strip()]
+    # Le sezioni vengono riunite con una riga vuota tra l'una e l'altra
+    remaining = max_chars - 2 * (len(sections) - 1)
+    if sum(len(section.split("\n", 1)[0]) for section in sections) > remaining:
+        # Non c'è spazio nemmeno per tutti i titoli: si ripiega sull'inizio delle note
+        return _truncate(notes, max_chars)
+    shares = [0] * len(sections)
+    by_length = sorted(range(len(sections)), key=lambda i: len(sections[i]))
+    for position, i in enumerate(by_length):
+        shares[i] = min(len(sections[i]), remaining // (len(sections) - position))
+        remaining -= shares[i]
+    condensed = [_condense_section(section, share) for section, share in zip(sections, shares)]
+    return "\n\n".join(section for section in condensed if section)
+
+def parse_merge_response(response):
+    """
+    Estrae riassunto e glossario dalla risposta del modello.
+
+    Returns:
+        Coppia (riassunto, dizionario termine -> definizione) o None se il formato non è valido.
+    """
+    if not response or SUMMARY_MARKER not in response:
+        return None
+    after_summary = response.split(SUMMARY_MARKER, 1)[1]
+    summary, _, glossary_text = after_summary.partition(GLOSSARY_MARKER)
+    glossary = {}
+    for line in glossary_text.splitlines():
+        match = _GLOSSARY_LINE.match(line)
+        if match:
+            glossary[match.group(1).strip()] = match.group(2).strip()
+    summary = summary.strip()
+    return (summary, glossary) if summary else None
+
+def _merge_glossary(old, new, added, now):
+    """
+    Glossario aggiornato: i termini restituiti dal modello hanno la precedenza, quelli
+    vecchi che ha omesso restano finché c'è spazio. Oltre MAX_GLOSSARY_TERMS vengono
+    scartati per primi i termini entrati nel corso da più tempo.
+
+    Args:
+        old: Glossario attuale (termine -> definizione).
+        new: Glossario restituito dal modello.
+        added: Momento (timestamp) in cui ogni termine attuale è entrato nel glossario.
+        now: Timestamp assegnato ai termini nuovi.
+
+    Returns:
+        Coppia (glossario in ordine alfabetico, termine -> timestamp di ingresso).
+    """
+    added_by_key = {term.lower(): timestamp for term, timestamp in added.items()}
+    candidates = [(term, _truncate(definition, MAX_DEFINITION_CHARS), added_by_key.get(term.lower(), now))
+                  for term, definition in new.items()]
+    known = {term.lower() for term in new}
+    omitted = [(term, definition, added_by_key.get(term.lower(), 0)) for term, definition in old.items()
+               if term.lower() not in known]
+    # Prima i termini del modello, poi quelli omessi; in ciascun gruppo i più recenti per primi
+    candidates.sort(key=lambda item: item[2], reverse=True)
+    omitted.sort(key=lambda item: item[2], reverse=True)
+    kept = sorted((candidates + omitted)[:MAX_GLOSSARY_TERMS], key=lambda item: item[0].lower())
+    return ({term: definition for term, definition, _ in kept},
+            {term: timestamp for term, _, timestamp in kept})
+
+async def add_lecture_to_course_async(course_name, lecture_notes, lecture_id=None, lecture_title=None,
+                                      gemini_api_key=None, mistral_api_key=None, update_callback=None,
+                                      priority=PRIORITY_INTERACTIVE, source_hash=None):
+    """
+    Integra le note di una lezione nel riassunto e nel glossario del corso con un solo
+    passo di fusione di dimensione limitata (riassunto, glossario e note hanno un tetto),
+    senza riassumere di nuovo le lezioni precedenti.
+
+    Args:
+        course_name: Nome del corso.
+        lecture_notes: Note della lezione (str o TextBuffer).
+        lecture_id: Identificativo della lezione (es. percorsi video/PDF), per non integrarla due volte.
+        lecture_title: Titolo mostrato nella guida (default: lecture_id).
+        source_hash: Impronta delle sorgenti della lezione (vedi lecture_source_hash): la lezione
+                     non viene integrata di nuovo finché non cambia (default: hash delle note).
+
+    Returns:
+        Stato aggiornato del corso o None in caso di errore.
+    """
+    def log_update(status_type, message):
+        if update_callback:
+            update_callback(status_type, message)
+        logger.info(f"{status_type.upper()}: {message}")
+
+    lecture_notes = text_value(lecture_notes) or ""
+    if not course_name or not course_name.strip() or not lecture_notes.strip():
+        log_update("error", "Servono il nome del corso e le note della lezione.")
+        return None
+    lecture_id = lecture_id or hashlib.sha256(lecture_notes.encode("utf-8")).hexdigest()[:16]
+    lecture_title = lecture_title or lecture_id
+    source_hash = source_hash or hashlib.sha256(lecture_notes.encode("utf-8")).hexdigest()[:16]
+
+    async with hold_lock(_course_lock(course_name)):
+        try:
+            state = await asyncio.to_thread(load_course, course_name)
+            previous = next((lecture for lecture in state["lectures"] if lecture["id"] == lecture_id), None)
+            if previous and previous.get("source_hash") == source_hash:
+                log_update("status", f"Lezione '{lecture_title}' già inclusa nel corso '{state['name']}'.")
+                return state
+
+            if len(lecture_notes) > MAX_LECTURE_CHARS:
+                log_update("warning", f"Note della lezione troppo lunghe: per il corso vengono condensate a {MAX_LECTURE_CHARS} "
+                                      f"caratteri, con titolo e prime righe di ogni sezione.")
+                lecture_notes = _condense_notes(lecture_notes, MAX_LECTURE_CHARS)
+            if previous:
+                lecture_title = f"{lecture_title} (versione aggiornata di una lezione già inclusa)"
+
+            log_update("status", f"Aggiornamento del corso '{state['name']}' con la lezione '{lecture_title}'...")
+            response = await merge_course_async(
+                state["name"], state["summary"], state["glossary"], lecture_title, lecture_notes,
+                MAX_SUMMARY_WORDS, MAX_GLOSSARY_TERMS, gemini_api_key, mistral_api_key, update_callback, priority=priority
+            )
+            parsed = parse_merge_response(response)
+            if parsed is None:
+                if response is not None:
+                    log_update("error", "Risposta del modello non valida: il corso non è stato modificato.")
+                return None
+
+            summary, glossary = parsed
+            now = time.time()
+            state["summary"] = _truncate(summary, MAX_SUMMARY_CHARS)
+            state["glossary"], state["glossary_added"] = _merge_glossary(
+                state["glossary"], glossary, state.get("glossary_added", {}), now
+            )
+            entry = {"id": lecture_id, "title": lecture_title if not previous else previous["title"],
+                     "source_hash": source_hash, "added_at": now}
+            if previous:
+                previous.update(entry)
+            else:
+                state["lectures"].append(entry)
+            await asyncio.to_thread(_save_course, state)
+            log_update("status", f"Corso '{state['name']}' aggiornato ({len(state['lectures'])} lezioni, {len(state['glossary'])} termini).")
+            return state
+        except Exception as e:
+            log_update("error", f"Errore durante l'aggiornamento del corso: {e}")
+            return None
+
+def add_lecture_to_course(course_name, lecture_notes, lecture_id=None, lecture_title=None, gemini_api_key=None,
+                          mistral_api_key=None, update_callback=None, priority=PRIORITY_INTERACTIVE, source_hash=None):
+    """Wrapper sincrono di add_lecture_to_course_async."""
+    return asyncio.run(add_lecture_to_course_async(
+        course_name, lecture_notes, lecture_id, lecture_title, gemini_api_key, mistral_api_key, update_callback, priority,
+        source_hash
+    ))
+
+def lecture_identity(video_path, pdf_path):
+    """Identificativo e titolo di una lezione a partire dai suoi file."""
+    files = [os.path.abspath(path) for path in (video_path, pdf_path) if path]
+    title = " + ".join(os.path.basename(path) for path in files)
+    return hashlib.sha256("|".join(files).encode("utf-8")).hexdigest()[:16], title
+
+def lecture_source_hash(video_path, pdf_path):
+    """
+    Impronta dei file di una lezione (percorso, dimensione, data di modifica): resta uguale
+    rielaborando gli stessi file, anche se le note generate sono diverse.
+    """
+    fingerprints = [file_fingerprint(path) for path in (video_path, pdf_path) if path and os.path.isfile(path)]
+    return hashlib.sha256("|".join(fingerprints).encode("utf-8")).hexdigest()[:16]
+
+def render_course(state):
+    """Guida di studio del corso in Markdown."""
+    parts = [f"# {state['name']}", "", "## Riassunto del corso", "", state["summary"] or "_Nessuna lezione ancora inclusa._"]
+    if state["glossary"]:
+        parts += ["", "## Glossario", ""]
+        parts += [f"- **{term}**: {definition}" for term, definition in state["glossary"].items()]
+    if state["lectures"]:
+        parts += ["", "## Lezioni incluse", ""]
+        parts += [f"{i}. {lecture['title']}" for i, lecture in enumerate(state["lectures"], 1)]
+    return "\n".join(parts) + "\n"
+
+def main(argv=None):
+    """Interfaccia a riga di comando: aggiunge note a un corso o ne stampa la guida."""
+    parser = argparse.ArgumentParser(description="Riassunto e glossario di corso di DeepNotes.")
+    parser.add_argument("--course", required=True, help="Nome del corso")
+    parser.add_argument("--add", nargs="+", metavar="NOTE", help="File di note (.md/.txt) da integrare, in ordine")
+    parser.add_argument("--output", help="File in cui salvare la guida del corso")
+    args = parser.parse_args(argv)
+
+    for notes_path in args.add or []:
+        with open(notes_path, encoding="utf-8") as f:
+            notes = f.read()
+        state = add_lecture_to_course(args.course, notes, lecture_id=os.path.abspath(notes_path),
+                                      lecture_title=os.path.basename(notes_path),
+                                      update_callback=lambda status, message: print(message))
+        if state is None:
+            return 1
+
+    guide = render_course(load_course(args.course))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(guide)
+    else:
+        print(guide)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
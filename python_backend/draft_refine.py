@@ -0,0 +1,203 @@
+import os
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .video_to_text import extract_and_transcribe
+from .sectioned_notes import load_sections, render_notes, section_time_ranges, replace_section_transcript_async, \
+    MATERIAL_CHANGE_SIMILARITY
+from .note_index import index_lecture
+from .course_notes import add_lecture_to_course, lecture_identity, lecture_source_hash
+from .utils.common import TextBuffer
+from .rate_limiter import PRIORITY_BATCH
+
+# Configurazione di base del logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Modello usato per affinare la bozza in background
+REFINE_MODEL_SIZE = "large-v3"
+# Priorità di sistema (nice) del thread di affinamento: cede la CPU all'elaborazione interattiva
+REFINE_NICENESS = 10
+
+def _lower_thread_priority():
+    """Abbassa la priorità del thread corrente (per thread su Linux, altrove ignorato)."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), REFINE_NICENESS)
+    except (AttributeError, OSError) as e:
+        logger.info(f"Impossibile abbassare la priorità del thread di affinamento: {e}")
+
+# Un solo affinamento alla volta, su un thread a bassa priorità
+_refine_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper-refine",
+                                      initializer=_lower_thread_priority)
+_lock = threading.Lock()
+# Affinamenti in corso o in attesa nell'executor
+_jobs = []
+
+class _RefineJob:
+    """Affinamento in corso per una lezione."""
+
+    def __init__(self, video_path, pdf_path):
+        self.key = (os.path.abspath(video_path), os.path.abspath(pdf_path) if pdf_path else None)
+        self.cancel_event = threading.Event()
+        self.future = None
+
+def refine_lecture(video_path, pdf_path=None, gemini_api_key=None, mistral_api_key=None, update_callback=None,
+                   notes_callback=None, model_size=REFINE_MODEL_SIZE, min_similarity=MATERIAL_CHANGE_SIMILARITY,
+                   cancel_event=None, course=None):
+    """
+    Ritrascrive con un modello più accurato una lezione già elaborata a sezioni,
+    sostituendo la trascrizione della bozza sezione per sezione. Le note di una
+    sezione vengono rigenerate solo se il testo è cambiato in modo sostanziale.
+
+    Args:
+        video_path: Percorso del video della lezione.
+        pdf_path: Percorso del PDF della lezione (come nell'elaborazione della bozza).
+        gemini_api_key: Chiave API per Google Gemini (opzionale).
+        mistral_api_key: Chiave API per Mistral (opzionale).
+        update_callback: Funzione callback per aggiornare lo stato nell'UI.
+        notes_callback: Funzione chiamata con le note complete ogni volta che una sezione cambia.
+        model_size: Modello Whisper di affinamento.
+        min_similarity: Somiglianza minima tra bozza e nuova trascrizione per non rigenerare le note.
+        cancel_event: threading.Event che interrompe l'affinamento tra una sezione e l'altra.
+        course: Corso in cui integrare le note al termine. Se l'affinamento viene annullato
+                il corso non cambia; se fallisce vi entrano le note parziali, senza registrare
+                l'impronta dei file, così una nuova elaborazione le sostituisce.
+
+    Returns:
+        Note complete affinate o None in caso di errore o annullamento.
+    """
+    def background_callback(status_type, message):
+        # La bozza resta valida: gli errori dell'affinamento arrivano all'UI come avvisi
+        if update_callback:
+            update_callback("warning" if status_type == "error" else status_type, message)
+
+    def log_update(status_type, message):
+        background_callback(status_type, message)
+        logger.info(f"{status_type.upper()}: {message}")
+
+    completed = cancelled = False
+    try:
+        state = load_sections(video_path, pdf_path)
+        if state is None:
+            log_update("error", "Affinamento impossibile: nessuna nota a sezioni salvata per questa lezione.")
+            return None
+
+        ranges = section_time_ranges(state)
+        regenerated = 0
+        for position, (section_index, start, end) in enumerate(ranges):
+            if cancel_event and cancel_event.is_set():
+                cancelled = True
+                log_update("status", "Affinamento della trascrizione annullato.")
+                return None
+            log_update("status", f"Affinamento trascrizione ({model_size}): sezione {position + 1}/{len(ranges)}...")
+
+            segments = []
+            # Solo l'intervallo della sezione; audio temporaneo per non riempire la cache con i ritagli
+            transcription = extract_and_transcribe(
+                video_path, None, model_size, start=start, end=end, use_cache=False,
+                segment_callback=lambda seg_start, seg_end, text: segments.append((seg_start, seg_end, text))
+            )
+            if transcription is None:
+                log_update("error", f"Affinamento interrotto: trascrizione della sezione {position + 1} non riuscita.")
+                return None
+            if not segments:
+                continue
+
+            notes, changed = asyncio.run(replace_section_transcript_async(
+                video_path, pdf_path, section_index, segments, gemini_api_key, mistral_api_key, background_callback,
+                priority=PRIORITY_BATCH, min_similarity=min_similarity
+            ))
+            if notes is None:
+                return None
+            if changed:
+                regenerated += 1
+                if notes_callback:
+                    notes_callback(notes)
+
+        state = load_sections(video_path, pdf_path)
+        notes = render_notes(state)
+        if notes:
+            # L'indice di ricerca riceve la trascrizione affinata, riletta a blocchi dai file delle sorgenti
+            with TextBuffer() as transcription, TextBuffer() as pdf_text:
+                for segment in state["segments"]:
+                    transcription.write((" " if transcription else "") + segment[2])
+                for page in state["pages"]:
+                    if page:
+                        pdf_text.write(("\n\n" if pdf_text else "") + page)
+                try:
+                    index_lecture(video_path, pdf_path, transcription, pdf_text, notes)
+                except Exception as index_error:
+                    log_update("warning", f"Impossibile aggiornare l'indice di ricerca: {index_error}")
+        log_update("status", f"Affinamento completato: note rigenerate per {regenerated} sezioni su {len(ranges)}.")
+        completed = True
+        return notes
+    except Exception as e:
+        log_update("error", f"Errore durante l'affinamento della trascrizione: {e}")
+        return None
+    finally:
+        # Con un nuovo affinamento della stessa lezione in coda, sarà quello a integrare il corso
+        if course and not cancelled and not _superseded(video_path, pdf_path, cancel_event):
+            _merge_into_course(video_path, pdf_path, course, gemini_api_key, mistral_api_key, background_callback,
+                               completed)
+
+def _merge_into_course(video_path, pdf_path, course, gemini_api_key, mistral_api_key, update_callback, completed):
+    """
+    Integra nel corso le note attuali della lezione. L'impronta dei file viene registrata
+    solo per le note affinate del tutto: quelle parziali sono identificate dal loro testo.
+    """
+    notes = render_notes(load_sections(video_path, pdf_path))
+    if not notes:
+        return
+    lecture_id, lecture_title = lecture_identity(video_path, pdf_path)
+    add_lecture_to_course(course, notes, lecture_id, lecture_title, gemini_api_key, mistral_api_key, update_callback,
+                          priority=PRIORITY_BATCH,
+                          source_hash=lecture_source_hash(video_path, pdf_path) if completed else None)
+
+def _superseded(video_path, pdf_path, cancel_event):
+    """True se un altro affinamento attivo della stessa lezione ha preso il posto di quello indicato."""
+    key = _RefineJob(video_path, pdf_path).key
+    with _lock:
+        return any(job.key == key and job.cancel_event is not cancel_event and not job.cancel_event.is_set()
+                   for job in _jobs)
+
+def _finished(job):
+    with _lock:
+        if job in _jobs:
+            _jobs.remove(job)
+
+def start_refinement(video_path, pdf_path=None, gemini_api_key=None, mistral_api_key=None, update_callback=None,
+                     notes_callback=None, model_size=REFINE_MODEL_SIZE, course=None):
+    """
+    Avvia refine_lecture in background e restituisce il Future.
+    Un affinamento precedente della stessa lezione viene annullato; quelli di altre
+    lezioni (es. in un batch) restano in coda: per interromperli usare cancel_refinement.
+    """
+    job = _RefineJob(video_path, pdf_path)
+    with _lock:
+        _cancel([other for other in _jobs if other.key == job.key])
+        job.future = _refine_executor.submit(
+            refine_lecture, video_path, pdf_path, gemini_api_key, mistral_api_key, update_callback,
+            notes_callback, model_size, cancel_event=job.cancel_event, course=course
+        )
+        _jobs.append(job)
+    job.future.add_done_callback(lambda future: _finished(job))
+    return job.future
+
+def _cancel(jobs):
+    # Senza future.cancel(): le sue callback (_finished) prenderebbero _lock, già acquisito dal chiamante.
+    # Un job in attesa parte, trova cancel_event impostato e termina subito.
+    for job in jobs:
+        job.cancel_event.set()
+
+def cancel_refinement(video_path=None, pdf_path=None):
+    """
+    Annulla gli affinamenti: quelli in attesa all'avvio, quello in corso al termine della sezione corrente.
+    Con video_path vengono annullati solo quelli di quella lezione, altrimenti tutti.
+    """
+    with _lock:
+        if video_path is None:
+            _cancel(_jobs)
+        else:
+            key = _RefineJob(video_path, pdf_path).key
+            _cancel([job for job in _jobs if job.key == key])
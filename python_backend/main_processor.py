@@ -1,16 +1,30 @@
 import os
 import time # Aggiunto per attesa finale opzionale
-from .video_to_text import extract_and_transcribe
-from .pdf_to_text import extract_text_from_pdf
-from .ai_fusion import merge_and_summarize
+import asyncio
+from .video_to_text import extract_and_transcribe_async
+from .pdf_to_text import extract_text_from_pdf_async, probe_pdf_text
+from .prefetch import get_prefetched, cancel_prefetch, SLOT_VIDEO
+from .ai_fusion import merge_and_summarize_async
+from .sectioned_notes import generate_sectioned_notes_async, new_source_spools, release_spools
+from .draft_refine import start_refinement
+from .course_notes import add_lecture_to_course_async, lecture_identity, lecture_source_hash
+from .note_index import index_lecture
+from .utils.common import TextBuffer, memory_ceiling_exceeded
+from .rate_limiter import PRIORITY_INTERACTIVE, PRIORITY_BATCH, format_stats
 # Import utils se necessario in futuro
 # from .utils import common
 
-def process_files(video_path, pdf_path, whisper_model_size="base", gemini_api_key=None, mistral_api_key=None, update_callback=None):
+# Intervallo di controllo della memoria per i job di un lotto in attesa sotto il tetto RSS
+MEMORY_ADMISSION_POLL_SECONDS = 1.0
+
+def process_files(video_path, pdf_path, whisper_model_size="base", gemini_api_key=None, mistral_api_key=None, update_callback=None,
+                  priority=PRIORITY_INTERACTIVE, video_start=None, video_end=None, chunk_seconds=None, sectioned=False,
+                  refine_model=None, notes_callback=None, course=None):
     """
     Orchestra l'intero processo: trascrizione video, estrazione PDF, fusione AI.
     Invoca i moduli specifici e usa update_callback per comunicare con la GUI.
-    
+    Wrapper sincrono di process_files_async, da chiamare fuori da un event loop.
+
     Args:
         video_path: Percorso al file video (può essere None).
         pdf_path: Percorso al file PDF (può essere None).
@@ -18,46 +32,174 @@ def process_files(video_path, pdf_path, whisper_model_size="base", gemini_api_ke
         gemini_api_key: Chiave API per Google Gemini (opzionale).
         mistral_api_key: Chiave API per Mistral (opzionale).
         update_callback: Funzione callback per aggiornare lo stato nell'UI.
+        priority: Priorità delle chiamate API (PRIORITY_INTERACTIVE per la GUI, PRIORITY_BATCH per i lotti).
+        video_start: Secondo da cui iniziare la trascrizione del video (opzionale).
+        video_end: Secondo a cui terminare la trascrizione del video (opzionale).
+        chunk_seconds: Durata dei blocchi audio estratti in parallelo (None = un solo blocco).
+        sectioned: Se True le note sono generate a sezioni collegate a trascrizione e pagine,
+            e alle esecuzioni successive si rigenerano solo le sezioni con sorgenti cambiate.
+        refine_model: Se indicato (es. "large-v3"), whisper_model_size produce una bozza rapida
+            (note a sezioni) e questo modello la affina in background sezione per sezione.
+        notes_callback: Funzione chiamata con le note aggiornate durante l'affinamento.
+        course: Nome del corso (opzionale): le note vengono integrate nel riassunto e glossario del corso.
+    """
+    return asyncio.run(process_files_async(
+        video_path, pdf_path, whisper_model_size, gemini_api_key, mistral_api_key, update_callback,
+        priority=priority, video_start=video_start, video_end=video_end, chunk_seconds=chunk_seconds,
+        sectioned=sectioned, refine_model=refine_model, notes_callback=notes_callback,
+        course=course
+    ))
+
+async def process_files_async(video_path, pdf_path, whisper_model_size="base", gemini_api_key=None, mistral_api_key=None,
+                              update_callback=None, priority=PRIORITY_INTERACTIVE, video_start=None, video_end=None,
+                              chunk_seconds=None, sectioned=False, refine_model=None, notes_callback=None,
+                              course=None):
+    """
+    Variante asyncio di process_files (stessi argomenti e valore di ritorno).
+    Trascrizione (in executor) e OCR (HTTP asincrono) procedono in parallelo,
+    e più job possono condividere lo stesso event loop.
     """
     video_transcription = None
     pdf_content = None
     final_summary = None
+    # Sorgenti granulari per le note a sezioni: segmenti (inizio, fine, testo) e pagine PDF
+    segments = pages = None
 
     def log_message(message, error=False):
         if update_callback:
             update_callback("error" if error else "status", message)
         print(message)
 
-    try:
+    # Percorsi inesistenti diventano None una volta sola, prima di usarli come chiavi
+    # di sezioni, indice di ricerca e corso
+    if video_path and not os.path.isfile(video_path):
+        log_message(f"File video non trovato o non valido: {video_path}", error=True)
+        video_path = None
+    if pdf_path and not os.path.isfile(pdf_path):
+        log_message(f"File PDF non trovato o non valido: {pdf_path}", error=True)
+        pdf_path = None
+
+    loop = asyncio.get_running_loop()
+    # L'affinamento sostituisce la trascrizione sezione per sezione: serve la versione a sezioni
+    refine = bool(refine_model and video_path and os.path.isfile(video_path) and refine_model != whisper_model_size)
+    sectioned = sectioned or refine
+    if sectioned:
+        # Scritte su disco man mano che arrivano, accanto allo stato delle sezioni
+        segments, pages = new_source_spools(video_path, pdf_path)
+
+    async def process_video():
         # --- Fase 1: Elaborazione Video (se fornito) ---
-        if video_path and os.path.exists(video_path):
+        if video_path:
             log_message(f"Utilizzo modello Whisper: {whisper_model_size}")
-            video_transcription = extract_and_transcribe(video_path, update_callback, whisper_model_size)
-            if video_transcription is None:
+            if video_start is None and video_end is None and not chunk_seconds:
+                # Un'estrazione speculativa ancora in corso viene attesa: il suo audio finisce in cache
+                if await loop.run_in_executor(None, get_prefetched, video_path, "audio"):
+                    log_message("Audio già estratto in anticipo, riutilizzo.")
+            else:
+                # Intervallo o blocchi: l'audio completo del prefetch non verrebbe usato
+                cancel_prefetch(SLOT_VIDEO)
+            # I testi intermedi restano in TextBuffer (RAM limitata, poi disco) fino alla fusione
+            transcription = await extract_and_transcribe_async(
+                video_path, update_callback, whisper_model_size, stream=True,
+                start=video_start, end=video_end, chunk_seconds=chunk_seconds,
+                segment_callback=(lambda start, end, text: segments.append([start, end, text])) if sectioned else None
+            )
+            if transcription is None:
                 raise Exception("Elaborazione video fallita.")
-        elif video_path:
-            log_message(f"File video non trovato o non valido: {video_path}", error=True)
+            return transcription
         else:
             log_message("Nessun file video fornito, saltando trascrizione.")
+        return None
 
+    async def process_pdf():
         # --- Fase 2: Elaborazione PDF (se fornito) ---
-        if pdf_path and os.path.exists(pdf_path):
-            pdf_content = extract_text_from_pdf(pdf_path, update_callback)
-            if pdf_content is None:
+        if pdf_path:
+            content_hash = await loop.run_in_executor(None, get_prefetched, pdf_path, "hash")
+            content = await extract_text_from_pdf_async(pdf_path, update_callback, stream=True, priority=priority,
+                                                        content_hash=content_hash,
+                                                        page_callback=(lambda i, text: pages.append(text)) if sectioned else None)
+            if content is None:
+                # OCR non disponibile: se ogni pagina ha testo incorporato, si usa quello
+                probe = await loop.run_in_executor(None, get_prefetched, pdf_path, "probe")
+                if probe is None:
+                    try:
+                        probe = await loop.run_in_executor(None, probe_pdf_text, pdf_path)
+                    except Exception as probe_error:
+                        print(f"Lettura del testo incorporato nel PDF non riuscita: {probe_error}")
+                if probe and probe["pages"] and probe["pages_with_text"] == probe["pages"]:
+                    if update_callback:
+                        update_callback("warning", "OCR non riuscito: uso il testo incorporato nel PDF.")
+                    content = TextBuffer()
+                    content.write(probe["text"])
+                    if sectioned and not len(pages):
+                        for text in probe["page_texts"]:
+                            pages.append(text)
+                    return content
                 raise Exception("Elaborazione PDF fallita.")
-        elif pdf_path:
-            log_message(f"File PDF non trovato o non valido: {pdf_path}", error=True)
+            return content
         else:
             log_message("Nessun file PDF fornito, saltando estrazione testo.")
+        return None
+
+    try:
+        # Fasi 1 e 2 in parallelo; le eccezioni vengono rilanciate dopo aver raccolto entrambi i risultati
+        video_transcription, pdf_content = await asyncio.gather(process_video(), process_pdf(), return_exceptions=True)
+        for result in (video_transcription, pdf_content):
+            if isinstance(result, Exception):
+                raise result
 
         # --- Fase 3: Fusione AI (se almeno un input è presente) ---
         if video_transcription or pdf_content:
             if not gemini_api_key and not mistral_api_key:
                 raise Exception("È necessario fornire almeno una chiave API (Gemini o Mistral) per la fusione AI.")
-            
-            final_summary = merge_and_summarize(video_transcription, pdf_content, gemini_api_key, mistral_api_key, update_callback)
+
+            if sectioned:
+                final_summary = await generate_sectioned_notes_async(video_path, pdf_path, segments, pages, gemini_api_key,
+                                                                     mistral_api_key, update_callback, priority=priority)
+            else:
+                final_summary = await merge_and_summarize_async(video_transcription, pdf_content, gemini_api_key, mistral_api_key,
+                                                                update_callback, priority=priority)
             if final_summary is None:
                 raise Exception("Fusione AI fallita.")
+
+            # --- Fase 4: Aggiornamento indice di ricerca (non bloccante per l'esito) ---
+            try:
+                await loop.run_in_executor(
+                    None, index_lecture, video_path, pdf_path, video_transcription, pdf_content, final_summary
+                )
+                log_message("Note aggiunte all'indice di ricerca.")
+            except Exception as index_error:
+                if update_callback:
+                    update_callback("warning", f"Impossibile aggiornare l'indice di ricerca: {index_error}")
+                print(f"Impossibile aggiornare l'indice di ricerca: {index_error}")
+
+            # --- Fase 5: Integrazione nel corso (non bloccante per l'esito) ---
+            if course and refine:
+                log_message(f"Il corso '{course}' verrà aggiornato con le note affinate, al termine dell'affinamento.")
+            elif course:
+                def course_callback(status_type, message):
+                    # Le note sono già pronte: un errore sul corso è solo un avviso
+                    if update_callback:
+                        update_callback("warning" if status_type == "error" else status_type, message)
+
+                lecture_id, lecture_title = lecture_identity(video_path, pdf_path)
+                course_state = await add_lecture_to_course_async(
+                    course, final_summary, lecture_id, lecture_title, gemini_api_key, mistral_api_key,
+                    course_callback, priority=priority, source_hash=lecture_source_hash(video_path, pdf_path)
+                )
+                if course_state is None:
+                    print(f"Impossibile aggiornare il corso '{course}'.")
+
+            # Code dei limiti API: riportate solo se ci sono state attese o risposte 429
+            rate_summary = format_stats(min_wait=1.0)
+            if rate_summary:
+                log_message(f"Limiti API (dall'avvio):\n{rate_summary}")
+
+            # --- Fase 6: Affinamento della bozza in background (opzionale) ---
+            if refine:
+                log_message(f"Bozza pronta. Affinamento con il modello '{refine_model}' in background...")
+                start_refinement(video_path, pdf_path, gemini_api_key, mistral_api_key, update_callback,
+                                 notes_callback, refine_model, course=course)
             return final_summary
         else:
             log_message("Nessun contenuto da elaborare per la fusione AI.", error=True)
@@ -66,4 +208,62 @@ def process_files(video_path, pdf_path, whisper_model_size="base", gemini_api_ke
     except Exception as e:
         error_message = f"Errore generale nel processo: {e}"
         log_message(error_message, error=True)
-        return f"ERRORE: {error_message}" 
\ No newline at end of file
+        return f"ERRORE: {error_message}"
+    finally:
+        for content in (video_transcription, pdf_content):
+            if isinstance(content, TextBuffer):
+                content.close()
+        if sectioned:
+            await loop.run_in_executor(None, release_spools, video_path, pdf_path, (segments, pages))
+
+async def process_batch_async(jobs, max_concurrency=8, update_callback=None, priority=PRIORITY_BATCH):
+    """
+    Elabora più coppie video/PDF sullo stesso event loop.
+
+    Args:
+        jobs: Lista di dizionari con gli argomenti di process_files_async
+              (video_path, pdf_path, whisper_model_size, gemini_api_key, mistral_api_key,
+              video_start, video_end, chunk_seconds, sectioned, refine_model, course).
+        max_concurrency: Numero massimo di job in corso contemporaneamente.
+        update_callback: Funzione callback condivisa per gli aggiornamenti.
+        priority: Priorità delle chiamate API (default batch, dietro ai job della GUI).
+
+    Returns:
+        Lista dei risultati nello stesso ordine di jobs.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    active = 0
+
+    async def run(job):
+        nonlocal active
+        async with semaphore:
+            # Tetto DEEPNOTES_MAX_RSS_MB: oltre il tetto un nuovo job parte solo quando
+            # non ce n'è nessuno in corso, altrimenti aspetta che la memoria scenda
+            reported = False
+            while active and memory_ceiling_exceeded():
+                if not reported:
+                    reported = True
+                    message = f"Tetto di memoria superato: {job.get('video_path') or job.get('pdf_path')} attende la fine dei job in corso."
+                    if update_callback:
+                        update_callback("status", message)
+                    print(message)
+                await asyncio.sleep(MEMORY_ADMISSION_POLL_SECONDS)
+            active += 1
+            try:
+                return await process_files_async(
+                    job.get("video_path"), job.get("pdf_path"), job.get("whisper_model_size", "base"),
+                    job.get("gemini_api_key"), job.get("mistral_api_key"), update_callback, priority=priority,
+                    video_start=job.get("video_start"), video_end=job.get("video_end"), chunk_seconds=job.get("chunk_seconds"),
+                    sectioned=job.get("sectioned", False), refine_model=job.get("refine_model"),
+                    course=job.get("course")
+                )
+            finally:
+                active -= 1
+
+    results = await asyncio.gather(*(run(job) for job in jobs))
+    rate_summary = format_stats()
+    if rate_summary:
+        if update_callback:
+            update_callback("status", f"Limiti API a fine lotto:\n{rate_summary}")
+        print(f"Limiti API a fine lotto:\n{rate_summary}")
+    return results
@@ -0,0 +1,306 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import logging
+import unicodedata
+import argparse
+import threading
+from .utils.common import iter_text_chunks
+
+# Configurazione di base del logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Percorso predefinito dell'indice (sovrascrivibile con DEEPNOTES_INDEX_PATH)
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".deepnotes", "notes_index.db")
+
+# Tipi di documento indicizzati per ogni lezione
+KIND_SUMMARY = "note"
+KIND_TRANSCRIPTION = "trascrizione"
+KIND_PDF = "pdf"
+
+# Serializza le scritture: process_files può girare in più thread
+_write_lock = threading.Lock()
+# Ricerca per prefisso sull'ultima parola (parola*): solo da MIN_PREFIX_CHARS caratteri e
+# se il prefisso corrisponde al massimo a MAX_PREFIX_TERMS termini indicizzati; oltre, il
+# costo della query cresce con il numero di termini e si cerca la parola esatta
+MIN_PREFIX_CHARS = 3
+MAX_PREFIX_TERMS = 50
+# Parole mostrate nello snippet di ogni risultato
+SNIPPET_WORDS = 16
+
+_WORD = re.compile(r"\w+")
+
+_DOCUMENTS_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+    kind UNINDEXED,
+    content,
+    lecture_id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3'
+)"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lectures (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    video_path TEXT NOT NULL DEFAULT '',
+    pdf_path TEXT NOT NULL DEFAULT '',
+    updated_at REAL NOT NULL,
+    UNIQUE (video_path, pdf_path)
+);
+""" + _DOCUMENTS_TABLE + ";\n"
+
+def get_index_path(index_path=None):
+    """Restituisce il percorso dell'indice: argomento, variabile d'ambiente o default."""
+    return index_path or os.getenv("DEEPNOTES_INDEX_PATH") or DEFAULT_INDEX_PATH
+
+def _connect(index_path=None):
+    """Apre (creandolo se necessario) il database SQLite con l'indice FTS5."""
+    path = get_index_path(index_path)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(_SCHEMA)
+    _migrate_prefix_index(conn)
+    return conn
+
+def _migrate_prefix_index(conn):
+    """Ricrea con gli indici dei prefissi una tabella documents creata da versioni precedenti."""
+    def needs_migration():
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'documents'").fetchone()
+        return row is not None and "prefix" not in row[0]
+
+    if not needs_migration():
+        return
+    with conn:
+        # Transazione esclusiva: un'altra connessione può aver già migrato nel frattempo
+        conn.execute("BEGIN IMMEDIATE")
+        if not needs_migration():
+            return
+        logger.info("Aggiornamento dell'indice di ricerca (indici dei prefissi)...")
+        conn.execute("ALTER TABLE documents RENAME TO documents_old")
+        conn.execute(_DOCUMENTS_TABLE)
+        conn.execute("INSERT INTO documents (rowid, kind, content, lecture_id) "
+                     "SELECT rowid, kind, content, lecture_id FROM documents_old")
+        conn.execute("DROP TABLE documents_old")
+
+def _lecture_title(video_path, pdf_path):
+    """Titolo leggibile della lezione ricavato dai nomi dei file sorgente."""
+    names = [os.path.basename(p) for p in (video_path, pdf_path) if p]
+    return " + ".join(names) if names else "Lezione senza titolo"
+
+def _fts_query(query, prefix=True):
+    """
+    Converte il testo dell'utente in una query FTS5 sicura.
+    Ogni parola viene quotata, così caratteri come '-' o ':' non vengono
+    interpretati come operatori; con prefix=True l'ultima parola accetta
+    prefissi se ha almeno MIN_PREFIX_CHARS caratteri.
+    """
+    terms = [t.replace('"', '""') for t in query.split() if t.strip('"')]
+    if not terms:
+        return None
+    quoted = [f'"{t}"' for t in terms]
+    if prefix and len(terms[-1].strip('"')) >= MIN_PREFIX_CHARS:
+        quoted[-1] += "*"
+    return " ".join(quoted)
+
+def _normalize_term(term):
+    """Termine come lo indicizza il tokenizer (minuscolo, senza diacritici)."""
+    decomposed = unicodedata.normalize("NFKD", term.strip('"').lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def _prefix_is_narrow(conn, term):
+    """True se al massimo MAX_PREFIX_TERMS termini indicizzati iniziano con term."""
+    prefix = _normalize_term(term)
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.documents_vocab USING fts5vocab(main, documents, 'row')")
+    count = conn.execute(
+        "SELECT count(*) FROM (SELECT 1 FROM temp.documents_vocab WHERE term >= ? AND term < ? LIMIT ?)",
+        (prefix, prefix + "\U0010ffff", MAX_PREFIX_TERMS + 1)
+    ).fetchone()[0]
+    return count <= MAX_PREFIX_TERMS
+
+def _snippet(content, terms, prefix, words=SNIPPET_WORDS):
+    """
+    Estratto di circa 'words' parole attorno alla prima occorrenza dei termini, evidenziati tra [ ].
+    Calcolato in Python sul blocco già scelto: snippet() di FTS5 rivaluta la query per ogni
+    riga, con costo che cresce con i termini in cui si espande un prefisso.
+    """
+    alternatives = [re.escape(term) for term in terms]
+    if prefix:
+        alternatives[-1] += r"\w*"
+    pattern = re.compile(r"\b(?:" + "|".join(alternatives) + r")\b", re.IGNORECASE)
+    match = pattern.search(content)
+    center = match.start() if match else 0
+    # Qualche parola prima della corrispondenza, il resto dopo
+    preceding = list(_WORD.finditer(content, max(0, center - 200), center))[-(words // 4):] if center else []
+    start = preceding[0].start() if preceding else center
+    window = [m for _, m in zip(range(words), _WORD.finditer(content, start))]
+    end = window[-1].end() if window else len(content)
+    text = pattern.sub(lambda m: f"[{m.group(0)}]", content[start:end])
+    return ("..." if start > 0 else "") + text + ("..." if end < len(content) else "")
+
+def index_lecture(video_path=None, pdf_path=None, transcription=None, pdf_text=None, summary=None,
+                  index_path=None, title=None):
+    """
+    Aggiunge (o aggiorna) una lezione nell'indice full-text.
+    Una lezione è identificata dalla coppia (video_path, pdf_path): se era già
+    presente, solo i suoi documenti vengono sostituiti (aggiornamento incrementale).
+
+    Args:
+        video_path: Percorso del video sorgente (può essere None).
+        pdf_path: Percorso del PDF sorgente (può essere None).
+        transcription: Trascrizione del video, str o TextBuffer (opzionale).
+        pdf_text: Testo estratto dal PDF, str o TextBuffer (opzionale).
+        summary: Note generate (opzionale).
+        index_path: Percorso del database (opzionale).
+        title: Titolo della lezione (default: nomi dei file).
+
+    Returns:
+        ID della lezione nell'indice.
+    """
+    video_key = os.path.abspath(video_path) if video_path else ""
+    pdf_key = os.path.abspath(pdf_path) if pdf_path else ""
+    documents = [
+        (KIND_SUMMARY, summary),
+        (KIND_TRANSCRIPTION, transcription),
+        (KIND_PDF, pdf_text),
+    ]
+
+    with _write_lock:
+        conn = _connect(index_path)
+        try:
+            with conn:
+                row = conn.execute(
+                    "SELECT id FROM lectures WHERE video_path = ? AND pdf_path = ?",
+                    (video_key, pdf_key)
+                ).fetchone()
+                if row:
+                    lecture_id = row[0]
+                    conn.execute(
+                        "UPDATE lectures SET title = ?, updated_at = ? WHERE id = ?",
+                        (title or _lecture_title(video_path, pdf_path), time.time(), lecture_id)
+                    )
+                    conn.execute("DELETE FROM documents WHERE lecture_id = ?", (lecture_id,))
+                else:
+                    cursor = conn.execute(
+                        "INSERT INTO lectures (title, video_path, pdf_path, updated_at) VALUES (?, ?, ?, ?)",
+                        (title or _lecture_title(video_path, pdf_path), video_key, pdf_key, time.time())
+                    )
+                    lecture_id = cursor.lastrowid
+                # I testi lunghi vengono indicizzati a blocchi: nessuna copia completa in memoria
+                conn.executemany(
+                    "INSERT INTO documents (kind, content, lecture_id) VALUES (?, ?, ?)",
+                    (
+                        (kind, chunk, lecture_id)
+                        for kind, content in documents
+                        for chunk in iter_text_chunks(content)
+                    )
+                )
+        finally:
+            conn.close()
+
+    logger.info(f"Lezione indicizzata (id {lecture_id}): {_lecture_title(video_path, pdf_path)}")
+    return lecture_id
+
+def search_notes(query, limit=20, index_path=None):
+    """
+    Cerca nell'indice e restituisce i risultati ordinati per rilevanza (BM25),
+    uno per documento (note, trascrizione o PDF di una lezione).
+
+    Args:
+        query: Testo da cercare.
+        limit: Numero massimo di risultati.
+        index_path: Percorso del database (opzionale).
+
+    Returns:
+        Lista di dizionari con chiavi 'lecture_id', 'title', 'kind',
+        'snippet', 'video_path', 'pdf_path', 'score'.
+    """
+    fts_query = _fts_query(query or "")
+    if not fts_query:
+        return []
+
+    conn = _connect(index_path)
+    try:
+        if fts_query.endswith("*") and not _prefix_is_narrow(conn, query.split()[-1]):
+            fts_query = _fts_query(query, prefix=False)
+        prefix = fts_query.endswith("*")
+
+        # Un documento lungo occupa più righe (blocchi): si tiene solo il blocco più rilevante
+        # per (lezione, tipo). Classifica e raggruppamento usano solo rowid e rank (BM25),
+        # scorrendo i risultati in ordine di rilevanza fino a limit documenti distinti
+        best = {}
+        for doc_id, lecture_id, kind, score in conn.execute(
+            "SELECT rowid, lecture_id, kind, rank FROM documents WHERE documents MATCH ? ORDER BY rank",
+            (fts_query,)
+        ):
+            if (lecture_id, kind) not in best:
+                best[(lecture_id, kind)] = (doc_id, score)
+                if len(best) >= limit:
+                    break
+        if not best:
+            return []
+
+        # Snippet e dati della lezione solo per i risultati finali
+        terms = [term.strip('"') for term in query.split() if term.strip('"')]
+        doc_ids = [doc_id for doc_id, _ in best.values()]
+        snippets = {
+            doc_id: _snippet(content, terms, prefix)
+            for doc_id, content in conn.execute(
+                f"SELECT rowid, content FROM documents WHERE rowid IN ({', '.join('?' * len(doc_ids))})",
+                tuple(doc_ids)
+            )
+        }
+        lecture_ids = {lecture_id for lecture_id, _ in best}
+        lectures = {row[0]: row[1:] for row in conn.execute(
+            f"SELECT id, title, video_path, pdf_path FROM lectures WHERE id IN ({', '.join('?' * len(lecture_ids))})",
+            tuple(lecture_ids)
+        )}
+    finally:
+        conn.close()
+
+    return [
+        {
+            "lecture_id": lecture_id,
+            "title": lectures[lecture_id][0],
+            "kind": kind,
+            "snippet": snippets.get(doc_id, ""),
+            "video_path": lectures[lecture_id][1],
+            "pdf_path": lectures[lecture_id][2],
+            "score": score,
+        }
+        for (lecture_id, kind), (doc_id, score) in best.items()
+        if lecture_id in lectures
+    ]
+
+def format_results(results):
+    """Formatta i risultati di ricerca come testo leggibile (GUI e CLI)."""
+    if not results:
+        return "Nessun risultato."
+    lines = []
+    for i, result in enumerate(results, 1):
+        lines.append(f"{i}. {result['title']} [{result['kind']}]")
+        lines.append(f"   {result['snippet']}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    """Interfaccia a riga di comando: python -m python_backend.note_index "query"."""
+    parser = argparse.ArgumentParser(description="Cerca nelle note, trascrizioni e testi PDF indicizzati da DeepNotes.")
+    parser.add_argument("query", nargs="+", help="Testo da cercare")
+    parser.add_argument("--limit", type=int, default=20, help="Numero massimo di risultati")
+    parser.add_argument("--index", default=None, help="Percorso del database dell'indice")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    results = search_notes(" ".join(args.query), limit=args.limit, index_path=args.index)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    print(format_results(results))
+    print(f"\n{len(results)} risultati in {elapsed_ms:.1f} ms")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
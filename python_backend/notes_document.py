@@ -0,0 +1,121 @@
+import os
+import re
+import uuid
+import logging
+import textwrap
+from .utils.common import DEFAULT_CHUNK_CHARS, text_value
+
+# Configurazione di base del logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Larghezza (caratteri) delle righe visualizzate e righe per pagina nel visualizzatore
+DEFAULT_WRAP_WIDTH = 110
+DEFAULT_PAGE_LINES = 40
+# Formati di salvataggio supportati (estensione -> descrizione)
+SAVE_FORMATS = {".md": "Markdown", ".txt": "Testo semplice"}
+
+_HEADING = re.compile(r"^\s{0,3}#{1,6}\s+")
+_EMPHASIS = re.compile(r"(\*\*|__|`)")
+_LINK = re.compile(r"\[([^\]]+)\]\([^)]*\)")
+
+def markdown_to_text(line):
+    """Converte una riga Markdown in testo semplice (titoli, grassetto, codice, link)."""
+    line = _HEADING.sub("", line)
+    line = _LINK.sub(r"\1", line)
+    return _EMPHASIS.sub("", line)
+
+class NotesDocument:
+    """
+    Copia di riferimento delle note generate, separata dal widget della GUI.
+    Il visualizzatore ne mostra una pagina alla volta (righe già spezzate alla
+    larghezza della finestra); salvataggio e copia leggono da qui, a blocchi.
+    """
+
+    def __init__(self, content, wrap_width=DEFAULT_WRAP_WIDTH):
+        self.text = text_value(content) or ""
+        self.wrap_width = wrap_width
+        self._lines = None
+        self._paragraph_starts = None
+
+    def __len__(self):
+        return len(self.text)
+
+    def _build_lines(self):
+        # Calcolato una sola volta, alla prima pagina richiesta
+        lines = []
+        paragraph_starts = []
+        for paragraph in self.text.split("\n"):
+            paragraph_starts.append(len(lines))
+            wrapped = textwrap.wrap(paragraph, self.wrap_width, replace_whitespace=False, drop_whitespace=True,
+                                    break_on_hyphens=False) if len(paragraph) > self.wrap_width else [paragraph]
+            lines.extend(wrapped or [""])
+        self._lines = lines
+        self._paragraph_starts = paragraph_starts
+
+    @property
+    def line_count(self):
+        """Numero di righe visualizzate (dopo l'a capo automatico)."""
+        if self._lines is None:
+            self._build_lines()
+        return len(self._lines)
+
+    def page_count(self, page_lines=DEFAULT_PAGE_LINES):
+        return max(1, -(-self.line_count // page_lines))
+
+    def get_page(self, page, page_lines=DEFAULT_PAGE_LINES):
+        """Testo della pagina indicata (da 0), limitato alle righe visibili."""
+        page = min(max(page, 0), self.page_count(page_lines) - 1)
+        return "\n".join(self._lines[page * page_lines:(page + 1) * page_lines])
+
+    def page_of_paragraph(self, paragraph_index, page_lines=DEFAULT_PAGE_LINES):
+        """Pagina che contiene il paragrafo (riga del testo originale) indicato."""
+        if self._lines is None:
+            self._build_lines()
+        index = min(max(paragraph_index, 0), len(self._paragraph_starts) - 1)
+        return self._paragraph_starts[index] // page_lines
+
+    def headings(self):
+        """Titoli Markdown del documento come coppie (indice del paragrafo, titolo)."""
+        return [(i, line.strip()) for i, line in enumerate(self.text.split("\n")) if _HEADING.match(line)]
+
+    def iter_chunks(self, chunk_chars=DEFAULT_CHUNK_CHARS, plain_text=False):
+        """Restituisce il contenuto a blocchi, opzionalmente convertito in testo semplice."""
+        if not plain_text:
+            for start in range(0, len(self.text), chunk_chars):
+                yield self.text[start:start + chunk_chars]
+            return
+        block = []
+        size = 0
+        for line in self.text.split("\n"):
+            block.append(markdown_to_text(line))
+            size += len(block[-1]) + 1
+            if size >= chunk_chars:
+                yield "\n".join(block) + "\n"
+                block, size = [], 0
+        if block:
+            yield "\n".join(block)
+
+    def save(self, file_path):
+        """
+        Salva le note a blocchi, in Markdown (.md) o testo semplice (.txt) secondo l'estensione;
+        un'estensione diversa riceve .md. Scrive su un file temporaneo e lo rinomina a fine scrittura.
+
+        Returns:
+            Percorso effettivo del file salvato.
+        """
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension not in SAVE_FORMATS:
+            file_path += ".md"
+            extension = ".md"
+        part_path = f"{file_path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(part_path, "w", encoding="utf-8") as f:
+                for chunk in self.iter_chunks(plain_text=extension == ".txt"):
+                    f.write(chunk)
+            os.replace(part_path, file_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        logger.info(f"Note salvate ({SAVE_FORMATS[extension]}): {file_path}")
+        return file_path
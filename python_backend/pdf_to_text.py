@@ -1,22 +1,122 @@
 import os
+import uuid
+import asyncio
 import logging
+import fitz  # PyMuPDF, per leggere il testo incorporato nel PDF
 from mistralai import Mistral  # Solo Mistral, niente eccezioni specifiche
+from .utils.common import TextBuffer, get_cache_dir, file_content_hash
+from .rate_limiter import call_with_rate_limit_async, PROVIDER_MISTRAL, PRIORITY_INTERACTIVE
 
 # Configurazione di base del logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def extract_text_from_pdf(pdf_path, update_callback=None, gui_mistral_api_key=None):
+# Caratteri minimi perché una pagina sia considerata dotata di testo incorporato
+MIN_TEXT_LAYER_CHARS = 20
+# Separatore di pagina nei file della cache OCR (non compare nel Markdown di Mistral)
+OCR_PAGE_SEPARATOR = "\f"
+
+def probe_pdf_text(pdf_path, min_chars_per_page=MIN_TEXT_LAYER_CHARS):
+    """
+    Legge con PyMuPDF il testo incorporato nel PDF, senza OCR.
+
+    Returns:
+        Dizionario con 'pages' (numero di pagine), 'pages_with_text' (pagine
+        con almeno min_chars_per_page caratteri), 'page_texts' (testo di ogni
+        pagina) e 'text' (testo di tutte le pagine).
+    """
+    with fitz.open(pdf_path) as doc:
+        pages = [page.get_text().strip() for page in doc]
+    return {
+        "pages": len(pages),
+        "pages_with_text": sum(1 for text in pages if len(text) >= min_chars_per_page),
+        "page_texts": pages,
+        "text": "\n\n".join(text for text in pages if text),
+    }
+
+def _ocr_cache_path(content_hash):
+    return os.path.join(get_cache_dir("ocr"), f"{content_hash}.md")
+
+def _load_cached_ocr(content_hash, page_callback=None):
+    """
+    Restituisce il Markdown OCR già calcolato per questo contenuto, o None.
+    Nel file le pagine sono separate da OCR_PAGE_SEPARATOR; page_callback riceve (indice, testo).
+    """
+    path = _ocr_cache_path(content_hash)
+    if not os.path.exists(path):
+        return None
+    buffer = TextBuffer()
+    index = 0
+
+    def add_page(page_text):
+        nonlocal index
+        page_text = page_text.strip()
+        if page_text:
+            buffer.write(("\n\n" if buffer else "") + page_text)
+        if page_callback:
+            page_callback(index, page_text)
+        index += 1
+
+    carry = ""
+    with open(path, encoding="utf-8") as f:
+        for block in iter(lambda: f.read(64 * 1024), ""):
+            *pages, carry = (carry + block).split(OCR_PAGE_SEPARATOR)
+            for page_text in pages:
+                add_page(page_text)
+    add_page(carry)
+    if not buffer:
+        buffer.close()
+        return None
+    return buffer
+
+def _store_cached_ocr(content_hash, pages):
+    """
+    Salva il Markdown OCR pagina per pagina su disco, con rinomina atomica.
+    pages può essere un iteratore: viene consumato fino in fondo anche se il salvataggio fallisce.
+    """
+    path = _ocr_cache_path(content_hash)
+    part_path = f"{path}.{uuid.uuid4().hex}.part"
+    pages = iter(pages)
+    try:
+        with open(part_path, "w", encoding="utf-8") as f:
+            for i, page_text in enumerate(pages):
+                f.write((OCR_PAGE_SEPARATOR if i else "") + page_text)
+        os.replace(part_path, path)
+    except OSError as e:
+        logger.warning(f"Impossibile salvare l'OCR in cache: {e}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        for _ in pages:
+            pass
+
+def extract_text_from_pdf(pdf_path, update_callback=None, gui_mistral_api_key=None, stream=False,
+                          priority=PRIORITY_INTERACTIVE, content_hash=None, page_callback=None):
     """
     Estrae il testo da un PDF usando esclusivamente l'API Mistral AI OCR.
+    Wrapper sincrono di extract_text_from_pdf_async (stessi argomenti e valore di ritorno).
+    """
+    return asyncio.run(extract_text_from_pdf_async(
+        pdf_path, update_callback, gui_mistral_api_key, stream=stream, priority=priority,
+        content_hash=content_hash, page_callback=page_callback
+    ))
+
+async def extract_text_from_pdf_async(pdf_path, update_callback=None, gui_mistral_api_key=None, stream=False,
+                                      priority=PRIORITY_INTERACTIVE, content_hash=None, page_callback=None):
+    """
+    Variante asyncio di extract_text_from_pdf: usa i metodi asincroni del client
+    Mistral, così più documenti possono essere in OCR sullo stesso event loop.
 
     Args:
         pdf_path: Percorso al file PDF.
         update_callback: Funzione callback per aggiornare lo stato nell'UI (opzionale).
         gui_mistral_api_key: Chiave API fornita dalla GUI (ha priorità).
+        stream: Se True restituisce un TextBuffer (memoria limitata) invece di una stringa.
+        priority: Priorità delle chiamate nello scheduler dei limiti (interattiva o batch).
+        content_hash: Hash del contenuto già calcolato (es. dal prefetch), usato per la cache OCR.
+        page_callback: Funzione chiamata per ogni pagina con (indice da 0, Markdown della pagina).
 
     Returns:
-        Testo estratto in formato Markdown o None in caso di errore.
+        Testo estratto in formato Markdown (str o TextBuffer) o None in caso di errore.
     """
     # Helper function per logging con/senza callback
     def log_update(status_type, message):
@@ -33,6 +133,17 @@ def extract_text_from_pdf(pdf_path, update_callback=None, gui_mistral_api_key=No
             log_update("error", f"File PDF non trovato: {pdf_path}")
             return None
 
+        # --- Cache OCR: lo stesso contenuto non viene inviato di nuovo a Mistral ---
+        if content_hash is None:
+            content_hash = await asyncio.to_thread(file_content_hash, pdf_path)
+        cached_text = await asyncio.to_thread(_load_cached_ocr, content_hash, page_callback)
+        if cached_text:
+            log_update("status", f"OCR di {os.path.basename(pdf_path)} riutilizzato dalla cache.")
+            if stream:
+                return cached_text
+            with cached_text:
+                return cached_text.getvalue()
+
         log_update("status", f"Inizio elaborazione PDF: {os.path.basename(pdf_path)} con Mistral AI...")
 
         # --- Logica Recupero API Key Mistral ---
@@ -62,52 +173,85 @@ def extract_text_from_pdf(pdf_path, update_callback=None, gui_mistral_api_key=No
             log_update("error", error_message)
             return None
 
+        # Tutte le chiamate passano dallo scheduler condiviso dei limiti Mistral
+        async def rate_limited(coro_fn):
+            return await call_with_rate_limit_async(
+                PROVIDER_MISTRAL, api_key, coro_fn, priority=priority, update_callback=update_callback
+            )
+
+        async def upload():
+            # Il file viene riaperto a ogni tentativo, così un retry dopo un 429 riparte dall'inizio
+            with open(pdf_path, "rb") as f:
+                return await client.files.upload_async(
+                    file={'file_name': os.path.basename(pdf_path), 'content': f},
+                    purpose='ocr'
+                )
+
         uploaded_file = None
         signed_url_response = None
         try:
             # --- Upload del file a Mistral ---
             log_update("status", "Upload del PDF a Mistral AI...")
-            with open(pdf_path, "rb") as f:
-                uploaded_file = client.files.upload(
-                    file={'file_name': os.path.basename(pdf_path), 'content': f},
-                    purpose='ocr'
-                )
+            uploaded_file = await rate_limited(upload)
             if not uploaded_file or not uploaded_file.id:
                 raise Exception("Upload file a Mistral fallito o ID non restituito.")
             log_update("status", f"Upload completato. File ID: {uploaded_file.id}")
 
             # --- Ottenere Signed URL (consigliato) ---
             log_update("status", "Ottenimento URL temporaneo per l'OCR...")
-            signed_url_response = client.files.get_signed_url(file_id=uploaded_file.id)
+            signed_url_response = await rate_limited(lambda: client.files.get_signed_url_async(file_id=uploaded_file.id))
             if not signed_url_response or not signed_url_response.url:
                 raise Exception("Ottenimento signed URL da Mistral fallito.")
             document_url = signed_url_response.url
             log_update("status", "URL ottenuto. Invio richiesta OCR a Mistral AI...")
 
             # --- Chiamata API OCR ---
-            ocr_response = client.ocr.process(
+            ocr_response = await rate_limited(lambda: client.ocr.process_async(
                 model="mistral-ocr-latest",
                 document={
                     "type": "document_url",
                     "document_url": document_url,
                 }
                 # Considera include_image_base64=False se non ti servono le immagini
-            )
+            ))
 
             # --- Estrazione Contenuto ---
             # --- NUOVA Logica Estrazione Contenuto ---
             if hasattr(ocr_response, 'pages') and ocr_response.pages:
-                extracted_text = ""
-                for page in ocr_response.pages:
-                    if hasattr(page, 'markdown') and page.markdown:
-                        extracted_text += page.markdown + "\n\n"  # Aggiungi markdown e spaziatura tra pagine
-                    else:
-                        logger.warning(f"Pagina {getattr(page, 'index', '?')} nella risposta OCR non contiene 'markdown'.")
+                # Le pagine vengono staccate dalla risposta una alla volta e scritte subito
+                # nel buffer e nella cache: il documento non resta in memoria una seconda volta
+                response_pages = ocr_response.pages
+                response_pages.reverse()
+                del ocr_response
+                extracted_text = TextBuffer()
+
+                def consume_pages():
+                    index = 0
+                    while response_pages:
+                        page = response_pages.pop()
+                        if hasattr(page, 'markdown') and page.markdown:
+                            # Markdown della pagina, separato dalla precedente da una riga vuota
+                            page_text = page.markdown.strip()
+                            extracted_text.write(("\n\n" if extracted_text else "") + page_text)
+                        else:
+                            page_text = ""
+                            logger.warning(f"Pagina {getattr(page, 'index', '?')} nella risposta OCR non contiene 'markdown'.")
+                        del page
+                        if page_callback:
+                            page_callback(index, page_text)
+                        index += 1
+                        yield page_text
+
+                await asyncio.to_thread(_store_cached_ocr, content_hash, consume_pages())
 
                 if extracted_text:
                     log_update("status", "OCR completato con successo da Mistral AI.")
-                    return extracted_text.strip()
+                    if stream:
+                        return extracted_text
+                    with extracted_text:
+                        return extracted_text.getvalue()
                 else:
+                    extracted_text.close()
                     # Caso in cui 'pages' esiste ma è vuota o nessuna pagina ha 'markdown'
                     logger.warning(f"Risposta OCR da Mistral conteneva 'pages' ma nessun contenuto markdown valido.")
                     raise Exception("Risposta OCR da Mistral non conteneva testo markdown valido.")
@@ -126,7 +270,7 @@ def extract_text_from_pdf(pdf_path, update_callback=None, gui_mistral_api_key=No
             if uploaded_file and uploaded_file.id:
                 try:
                     logger.info(f"Tentativo di eliminare file {uploaded_file.id} da Mistral AI.")
-                    client.files.delete(file_id=uploaded_file.id)
+                    await rate_limited(lambda: client.files.delete_async(file_id=uploaded_file.id))
                 except Exception as delete_err:
                     # Non critico, logga solo l'errore
                     logger.warning(f"Impossibile eliminare file {uploaded_file.id} da Mistral AI: {delete_err}")
@@ -0,0 +1,162 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .utils.common import file_content_hash, file_fingerprint
+from .video_to_text import extract_audio, get_whisper_model, ExtractionCancelled
+from .pdf_to_text import probe_pdf_text
+
+# Configurazione di base del logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Slot di prefetch: un file per tipo, come nella GUI
+SLOT_VIDEO = "video"
+SLOT_PDF = "pdf"
+# Slot del modello Whisper caricato in anticipo (uno alla volta)
+SLOT_MODEL = "model"
+# Attesa prima di caricare il modello scelto: scorrendo le voci della combo parte solo l'ultimo
+WARM_UP_DELAY_SECONDS = 1.0
+
+# Pochi worker: il prefetch non deve competere con l'elaborazione vera e propria
+_executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="prefetch")
+_lock = threading.Lock()
+_entries = {}
+
+class _PrefetchEntry:
+    """Lavoro speculativo avviato per un file selezionato."""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.fingerprint = file_fingerprint(path)
+        self.cancel_event = threading.Event()
+        self.futures = {}
+
+    def cancel(self):
+        self.cancel_event.set()
+        for future in self.futures.values():
+            future.cancel()
+
+class _ModelEntry(_PrefetchEntry):
+    """Caricamento anticipato di un modello Whisper: non è legato a un file."""
+
+    def __init__(self, model_size):
+        self.path = None
+        self.fingerprint = None
+        self.model_size = model_size
+        self.cancel_event = threading.Event()
+        self.futures = {}
+
+def _submit(entry, name, fn, *args, **kwargs):
+    def run():
+        if entry.cancel_event.is_set():
+            return None
+        try:
+            return fn(*args, **kwargs)
+        except ExtractionCancelled:
+            logger.info(f"Prefetch '{name}' annullato per {os.path.basename(entry.path)}.")
+            return None
+    entry.futures[name] = _executor.submit(run)
+
+def _replace_entry(slot, path):
+    """Annulla il prefetch precedente dello slot e ne registra uno nuovo (None se già in corso)."""
+    with _lock:
+        current = _entries.get(slot)
+        if current and current.path == os.path.abspath(path) and not current.cancel_event.is_set() \
+                and current.fingerprint == file_fingerprint(path):
+            return None
+        if current:
+            current.cancel()
+        entry = _PrefetchEntry(path)
+        _entries[slot] = entry
+        return entry
+
+def prefetch_video(video_path, model_size=None):
+    """
+    Avvia in background l'estrazione audio (che finisce nella cache audio) e,
+    se indicato, il caricamento del modello Whisper. Annulla il prefetch del video precedente.
+    """
+    if not video_path or not os.path.isfile(video_path):
+        return
+    entry = _replace_entry(SLOT_VIDEO, video_path)
+    if entry is not None:
+        logger.info(f"Prefetch video avviato: {os.path.basename(video_path)}")
+        _submit(entry, "audio", extract_audio, video_path, cancel_event=entry.cancel_event)
+    if model_size:
+        warm_up_whisper(model_size)
+
+def prefetch_pdf(pdf_path):
+    """
+    Avvia in background l'hash del contenuto (chiave della cache OCR) e la lettura
+    del testo incorporato con PyMuPDF. Annulla il prefetch del PDF precedente.
+    """
+    if not pdf_path or not os.path.isfile(pdf_path):
+        return
+    entry = _replace_entry(SLOT_PDF, pdf_path)
+    if entry is not None:
+        logger.info(f"Prefetch PDF avviato: {os.path.basename(pdf_path)}")
+        _submit(entry, "hash", file_content_hash, pdf_path)
+        _submit(entry, "probe", probe_pdf_text, pdf_path)
+
+def warm_up_whisper(model_size):
+    """
+    Carica in background il modello Whisper, che resta pronto per la trascrizione.
+    Se lo stesso modello è già in attesa non fa nulla; un altro modello in attesa viene
+    annullato (un caricamento già iniziato non è interrompibile e arriva comunque al termine).
+    """
+    if not model_size:
+        return
+    entry = _ModelEntry(model_size)
+
+    def load():
+        # Se nel frattempo viene scelto un altro modello, questo non viene caricato
+        if entry.cancel_event.wait(WARM_UP_DELAY_SECONDS):
+            return None
+        logger.info(f"Caricamento anticipato del modello Whisper '{model_size}'.")
+        return get_whisper_model(model_size)
+
+    with _lock:
+        current = _entries.get(SLOT_MODEL)
+        if current and current.model_size == model_size and not current.cancel_event.is_set() \
+                and not current.futures["model"].done():
+            return
+        if current:
+            current.cancel()
+        _entries[SLOT_MODEL] = entry
+        _submit(entry, "model", load)
+
+def cancel_prefetch(slot=None):
+    """Annulla il prefetch di uno slot (SLOT_VIDEO/SLOT_PDF/SLOT_MODEL) o di tutti."""
+    with _lock:
+        slots = [slot] if slot else list(_entries)
+        for name in slots:
+            entry = _entries.pop(name, None)
+            if entry:
+                entry.cancel()
+
+def get_prefetched(path, name, wait=True):
+    """
+    Restituisce il risultato del prefetch 'name' ('audio', 'hash', 'probe') per path,
+    oppure None se non è stato avviato, è stato annullato, è fallito o il file è cambiato.
+    Con wait=True attende il completamento di un prefetch ancora in corso.
+    """
+    if not path:
+        return None
+    with _lock:
+        entry = next((e for e in _entries.values() if e.path == os.path.abspath(path)), None)
+    if entry is None or entry.cancel_event.is_set() or name not in entry.futures:
+        return None
+    future = entry.futures[name]
+    if not wait and not future.done():
+        return None
+    try:
+        result = future.result()
+    except Exception as e:
+        logger.warning(f"Prefetch '{name}' fallito per {os.path.basename(path)}: {e}")
+        return None
+    try:
+        if file_fingerprint(path) != entry.fingerprint:
+            return None
+    except OSError:
+        return None
+    return result
@@ -0,0 +1,279 @@
+import os
+import time
+import asyncio
+import heapq
+import hashlib
+import logging
+import itertools
+import threading
+
+# Configurazione di base del logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Priorità delle richieste: valori più bassi vengono serviti prima
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+# Provider supportati
+PROVIDER_GEMINI = "gemini"
+PROVIDER_MISTRAL = "mistral"
+
+# Limiti predefiniti (richieste/minuto, token/minuto), sovrascrivibili con
+# DEEPNOTES_<PROVIDER>_RPM e DEEPNOTES_<PROVIDER>_TPM
+DEFAULT_LIMITS = {
+    PROVIDER_GEMINI: (10, 1_000_000),
+    PROVIDER_MISTRAL: (60, 500_000),
+}
+
+# Attesa usata dopo un 429 se il provider non indica Retry-After
+DEFAULT_RETRY_AFTER = 10.0
+# Intervallo di controllo delle coroutine in coda dietro ad altre richieste
+ASYNC_POLL_INTERVAL = 0.05
+# Attesa (secondi) oltre la quale lo stato della coda viene mostrato all'utente
+SLOW_WAIT_SECONDS = 5.0
+
+class RateLimitedError(Exception):
+    """Il provider ha risposto con un errore di quota (HTTP 429)."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def estimate_tokens(*texts):
+    """Stima grossolana dei token (circa 4 caratteri per token) per str o TextBuffer."""
+    return sum(len(t) for t in texts if t) // 4
+
+def _key_id(api_key):
+    """Identificativo non reversibile della chiave API, usato per separare i limiti."""
+    if not api_key:
+        return "default"
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+def _limit_from_env(provider, suffix, default):
+    value = os.getenv(f"DEEPNOTES_{provider.upper()}_{suffix}")
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning(f"Valore non valido per DEEPNOTES_{provider.upper()}_{suffix}: {value}")
+        return default
+
+class TokenBucket:
+    """Secchio di token che si ricarica in modo continuo fino a per_minute unità al minuto."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount, now):
+        """Secondi da attendere prima che amount unità siano disponibili (0 = subito)."""
+        self._refill(now)
+        # Una richiesta più grande della capacità attende solo il secchio pieno
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        self.level -= min(amount, self.capacity)
+
+class _ProviderLimiter:
+    """Limiti e statistiche per una coppia (provider, chiave API)."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.blocked_until = 0.0
+        self.waiters = []
+        self.served = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def try_consume(self, tokens):
+        """Consuma una richiesta e tokens token se possibile, altrimenti restituisce l'attesa necessaria."""
+        now = time.monotonic()
+        delay = max(
+            self.blocked_until - now,
+            self.requests.delay_for(1, now),
+            self.tokens.delay_for(tokens, now) if tokens else 0.0,
+        )
+        if delay > 0:
+            return delay
+        self.requests.consume(1)
+        if tokens:
+            self.tokens.consume(tokens)
+        return 0.0
+
+class RateLimitScheduler:
+    """
+    Scheduler condiviso tra OCR Mistral e chiamate di fusione (Gemini/Mistral).
+    Ogni coppia (provider, chiave) ha limiti separati di richieste/minuto e
+    token/minuto; le richieste in attesa vengono servite per priorità e poi in
+    ordine di arrivo, così i job interattivi della GUI superano quelli batch.
+    """
+
+    def __init__(self, limits=None):
+        self._limits = dict(DEFAULT_LIMITS)
+        if limits:
+            self._limits.update(limits)
+        # Più event loop (thread diversi) possono usare lo scheduler contemporaneamente
+        self._lock = threading.Lock()
+        self._limiters = {}
+        self._seq = itertools.count()
+
+    def _get_limiter(self, provider, api_key):
+        key = (provider, _key_id(api_key))
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            rpm, tpm = self._limits.get(provider, (60, 1_000_000))
+            limiter = _ProviderLimiter(
+                _limit_from_env(provider, "RPM", rpm),
+                _limit_from_env(provider, "TPM", tpm),
+            )
+            self._limiters[key] = limiter
+        return limiter
+
+    async def acquire_async(self, provider, api_key=None, tokens=0, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """
+        Attende, senza bloccare l'event loop, che la richiesta possa essere inviata
+        senza superare i limiti. Tutti gli event loop del processo (es. più chiamate
+        a process_files da thread diversi) condividono la stessa coda.
+
+        Args:
+            provider: Nome del provider (PROVIDER_GEMINI o PROVIDER_MISTRAL).
+            api_key: Chiave API usata (i limiti sono separati per chiave).
+            tokens: Token stimati della richiesta.
+            priority: PRIORITY_INTERACTIVE o PRIORITY_BATCH.
+            timeout: Attesa massima in secondi (None = illimitata).
+
+        Returns:
+            Secondi di attesa effettivi.
+        """
+        start = time.monotonic()
+        with self._lock:
+            limiter = self._get_limiter(provider, api_key)
+            ticket = (priority, next(self._seq))
+            heapq.heappush(limiter.waiters, ticket)
+        try:
+            while True:
+                with self._lock:
+                    if limiter.waiters[0] == ticket:
+                        delay = limiter.try_consume(tokens)
+                        if delay == 0:
+                            break
+                    else:
+                        delay = ASYNC_POLL_INTERVAL
+                if timeout is not None:
+                    remaining = timeout - (time.monotonic() - start)
+                    if remaining <= 0:
+                        raise TimeoutError(f"Attesa del limite di richieste {provider} oltre {timeout}s.")
+                    delay = min(delay, remaining)
+                await asyncio.sleep(delay)
+        finally:
+            with self._lock:
+                limiter.waiters.remove(ticket)
+                heapq.heapify(limiter.waiters)
+
+        waited = time.monotonic() - start
+        with self._lock:
+            self._record_wait(limiter, waited)
+        return waited
+
+    @staticmethod
+    def _record_wait(limiter, waited):
+        limiter.served += 1
+        limiter.total_wait += waited
+        limiter.max_wait = max(limiter.max_wait, waited)
+
+    def report_rate_limited(self, provider, api_key=None, retry_after=None):
+        """Sospende le richieste verso (provider, chiave) dopo un 429 del provider."""
+        with self._lock:
+            limiter = self._get_limiter(provider, api_key)
+            pause = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+            limiter.blocked_until = max(limiter.blocked_until, time.monotonic() + pause)
+            limiter.throttled += 1
+
+    def stats(self):
+        """
+        Statistiche osservabili per ogni coppia (provider, chiave):
+        richieste in coda, servite, 429 ricevuti, attesa media e massima.
+        """
+        with self._lock:
+            return {
+                f"{provider}:{key_id}": {
+                    "queue_depth": len(limiter.waiters),
+                    "served": limiter.served,
+                    "throttled": limiter.throttled,
+                    "avg_wait": limiter.total_wait / limiter.served if limiter.served else 0.0,
+                    "max_wait": limiter.max_wait,
+                }
+                for (provider, key_id), limiter in self._limiters.items()
+            }
+
+_scheduler = RateLimitScheduler()
+
+def get_scheduler():
+    """Restituisce lo scheduler condiviso del processo."""
+    return _scheduler
+
+def format_stats(stats=None, min_wait=0.0):
+    """
+    Riepilogo leggibile delle statistiche dello scheduler, una riga per provider e chiave.
+    Con min_wait vengono riportate solo le code che hanno atteso almeno tanto o ricevuto 429.
+    Restituisce None se non c'è nulla da riportare.
+    """
+    stats = get_scheduler().stats() if stats is None else stats
+    lines = [
+        f"{name}: {item['queue_depth']} in coda, {item['served']} servite, {item['throttled']} risposte 429, "
+        f"attesa media {item['avg_wait']:.1f}s, massima {item['max_wait']:.1f}s"
+        for name, item in stats.items()
+        if item["max_wait"] >= min_wait or item["throttled"]
+    ]
+    return "\n".join(lines) or None
+
+def _retry_after_from_error(error):
+    """Restituisce l'attesa suggerita se error è un errore di quota, altrimenti None."""
+    if isinstance(error, RateLimitedError):
+        return error.retry_after if error.retry_after is not None else DEFAULT_RETRY_AFTER
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if status == 429 or type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return DEFAULT_RETRY_AFTER
+    return None
+
+async def call_with_rate_limit_async(provider, api_key, coro_fn, tokens=0, priority=PRIORITY_INTERACTIVE,
+                                     max_retries=3, update_callback=None):
+    """
+    Esegue coro_fn() rispettando i limiti del provider; in caso di 429 sospende
+    la coda per la chiave e riprova fino a max_retries volte.
+    coro_fn() deve restituire una nuova coroutine a ogni chiamata.
+    """
+    scheduler = get_scheduler()
+    for attempt in range(max_retries + 1):
+        waited = await scheduler.acquire_async(provider, api_key, tokens=tokens, priority=priority)
+        if waited >= 1:
+            queue = scheduler.stats().get(f"{provider}:{_key_id(api_key)}", {})
+            message = f"Limite di richieste {provider}: atteso {waited:.1f}s (altre richieste in coda: {queue.get('queue_depth', 0)})."
+            if waited >= SLOW_WAIT_SECONDS:
+                logger.warning(f"{message} {format_stats({provider: queue}) or ''}")
+            if update_callback:
+                update_callback("warning" if waited >= SLOW_WAIT_SECONDS else "status", message)
+        try:
+            return await coro_fn()
+        except Exception as e:
+            retry_after = _retry_after_from_error(e)
+            if retry_after is None or attempt == max_retries:
+                raise
+            scheduler.report_rate_limited(provider, api_key, retry_after)
+            message = f"Quota {provider} superata (429), nuovo tentativo tra {retry_after:.1f}s..."
+            logger.warning(message)
+            if update_callback:
+                update_callback("warning", message)
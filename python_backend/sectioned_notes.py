@@ -0,0 +1,548 @@
+import os
+import sys
+import json
+import uuid
+import asyncio
+import difflib
+import hashlib
+import logging
+import argparse
+import itertools
+import threading
+from .ai_fusion import summarize_section_async
+from .utils.common import get_cache_dir, hold_lock
+from .rate_limiter import PRIORITY_INTERACTIVE
+
+# Configurazione di base del logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Durata (secondi) della parte di lezione coperta da una sezione
+DEFAULT_SECTION_SECONDS = 600
+# Pagine per sezione quando non c'è un video a cui agganciarle
+DEFAULT_PAGES_PER_SECTION = 5
+# Sezioni generate contemporaneamente (i limiti API restano allo scheduler)
+MAX_PARALLEL_SECTIONS = 4
+STATE_VERSION = 2
+# Sorgenti granulari, salvate ciascuna nel proprio file accanto allo stato
+_SOURCE_KINDS = ("segments", "pages")
+# Somiglianza (tra parole) sotto la quale una trascrizione sostituita è considerata cambiata
+MATERIAL_CHANGE_SIMILARITY = 0.85
+
+_lock = threading.Lock()
+_locks_guard = threading.Lock()
+_lecture_locks = {}
+
+def _state_path(video_path, pdf_path):
+    """File JSON con le sezioni di una lezione, identificata dalla coppia video/PDF."""
+    key = f"{os.path.abspath(video_path) if video_path else ''}|{os.path.abspath(pdf_path) if pdf_path else ''}"
+    return os.path.join(get_cache_dir("notes"), hashlib.sha256(key.encode("utf-8")).hexdigest()[:16] + ".json")
+
+class SourceSpool:
+    """
+    Sorgenti granulari di una lezione (segmenti [inizio, fine, testo] o testi delle pagine)
+    scritte su disco una per riga, in JSON, man mano che arrivano. In memoria restano solo
+    gli offset delle righe: ogni elemento viene riletto dal file quando serve.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._offsets = []
+        self._writer = None
+        self._write_lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                offset = 0
+                for line in f:
+                    self._offsets.append(offset)
+                    offset += len(line)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def append(self, item):
+        """Aggiunge un elemento in coda (sicuro tra thread)."""
+        line = (json.dumps(item, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = open(self.path, "ab")
+            self._writer.seek(0, os.SEEK_END)
+            self._offsets.append(self._writer.tell())
+            self._writer.write(line)
+
+    def close(self):
+        """Chiude il file in scrittura (gli elementi restano leggibili)."""
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def read(self, indices):
+        """Elementi agli indici indicati, letti con una sola apertura del file."""
+        indices = list(indices)
+        if not indices:
+            return []
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.flush()
+        with open(self.path, "rb") as f:
+            items = []
+            for index in indices:
+                f.seek(self._offsets[index])
+                items.append(json.loads(f.readline()))
+            return items
+
+    def __getitem__(self, index):
+        return self.read([index])[0]
+
+    def __iter__(self):
+        count = len(self._offsets)
+        if not count:
+            return
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.flush()
+        with open(self.path, "rb") as f:
+            for line in itertools.islice(f, count):
+                yield json.loads(line)
+
+def _spool_path(video_path, pdf_path, kind):
+    """Nuovo file per le sorgenti 'kind' della lezione: ogni versione ha il suo nome."""
+    stem = os.path.splitext(_state_path(video_path, pdf_path))[0]
+    return f"{stem}.{uuid.uuid4().hex[:8]}.{kind}.jsonl"
+
+def new_source_spools(video_path, pdf_path):
+    """
+    Coppia (segmenti, pagine) di SourceSpool vuoti, da riempire durante trascrizione e OCR
+    e da passare a generate_sectioned_notes_async; chiudere poi con release_spools.
+    """
+    return tuple(SourceSpool(_spool_path(video_path, pdf_path, kind)) for kind in _SOURCE_KINDS)
+
+def _read_state_file(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def _remove_spool_files(paths):
+    for path in paths:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"Impossibile eliminare il file di sorgenti {path}: {e}")
+
+def _referenced_spools(path):
+    """Percorsi dei file di sorgenti usati dallo stato salvato in path (vuoto se manca)."""
+    try:
+        state = _read_state_file(path)
+    except (OSError, ValueError):
+        return set()
+    directory = os.path.dirname(path)
+    return {os.path.join(directory, state[f"{kind}_file"]) for kind in _SOURCE_KINDS if state.get(f"{kind}_file")}
+
+def _lecture_lock(video_path, pdf_path):
+    """
+    Lock per lezione: caricamento, generazione e salvataggio delle sezioni avvengono
+    come un solo passo, così un affinamento, una rigenerazione e una nuova elaborazione
+    della stessa lezione non si sovrascrivono a vicenda.
+    """
+    with _locks_guard:
+        return _lecture_locks.setdefault(_state_path(video_path, pdf_path), threading.Lock())
+
+def load_sections(video_path, pdf_path):
+    """Restituisce lo stato salvato della lezione (sezioni e SourceSpool delle sorgenti), o None."""
+    path = _state_path(video_path, pdf_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        state = _read_state_file(path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Stato delle sezioni illeggibile ({path}): {e}")
+        return None
+    if state.get("version") != STATE_VERSION:
+        return None
+    for kind in _SOURCE_KINDS:
+        state[kind] = SourceSpool(os.path.join(os.path.dirname(path), state[f"{kind}_file"]))
+    return state
+
+def _save_state(state):
+    """
+    Salva i metadati delle sezioni con rinomina atomica. Le sorgenti restano nei loro
+    file (non vengono riscritte); quelli della versione precedente vengono eliminati.
+    """
+    path = _state_path(state["video_path"], state["pdf_path"])
+    part_path = f"{path}.{uuid.uuid4().hex}.part"
+    data = {key: value for key, value in state.items() if key not in _SOURCE_KINDS}
+    for kind in _SOURCE_KINDS:
+        state[kind].close()
+        data[f"{kind}_file"] = os.path.basename(state[kind].path)
+    with _lock:
+        previous = _referenced_spools(path)
+        try:
+            with open(part_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        _remove_spool_files(previous - {state[kind].path for kind in _SOURCE_KINDS})
+
+def release_spools(video_path, pdf_path, spools):
+    """Chiude i SourceSpool di un'elaborazione ed elimina quelli che lo stato salvato non usa."""
+    with _lock:
+        referenced = _referenced_spools(_state_path(video_path, pdf_path))
+        for spool in spools:
+            spool.close()
+        _remove_spool_files(spool.path for spool in spools if spool.path not in referenced)
+
+def build_sections(segments, pages, section_seconds=DEFAULT_SECTION_SECONDS, pages_per_section=DEFAULT_PAGES_PER_SECTION,
+                   page_sections=None):
+    """
+    Divide la lezione in sezioni collegate alle sorgenti.
+
+    Args:
+        segments: Segmenti (inizio, fine, testo) della trascrizione, in ordine (lista o SourceSpool).
+        pages: Testi delle pagine PDF, indice = pagina da 0 (lista o SourceSpool).
+        section_seconds: Durata di ogni finestra di trascrizione.
+        pages_per_section: Pagine per sezione se manca la trascrizione.
+        page_sections: Sezione di ogni pagina nell'elaborazione precedente (vedi _carry_page_sections),
+                       None per le pagine aggiunte in fondo; senza, le pagine vengono distribuite da capo.
+
+    Returns:
+        Lista di dizionari con index, start, end (secondi o None), segments e pages (indici).
+    """
+    sections = []
+    # Finestre temporali consecutive sulla trascrizione
+    for i, (start, end, _) in enumerate(segments):
+        if not sections or start >= sections[-1]["start"] + section_seconds:
+            sections.append({"start": start, "end": end, "segments": [], "pages": []})
+        sections[-1]["end"] = end
+        sections[-1]["segments"].append(i)
+
+    carried = list(page_sections or [])[:len(pages)]
+    carried += [None] * (len(pages) - len(carried))
+    if sections:
+        for p in range(len(pages)):
+            if page_sections is None:
+                # Le pagine seguono l'andamento della lezione: distribuzione proporzionale sulle finestre
+                target = p * len(sections) // len(pages)
+            elif carried[p] is None:
+                target = len(sections) - 1
+            else:
+                target = min(carried[p], len(sections) - 1)
+            sections[target]["pages"].append(p)
+    else:
+        groups = {}
+        for p, section in enumerate(carried):
+            if section is not None:
+                groups.setdefault(section, []).append(p)
+        for section in sorted(groups):
+            sections.append({"start": None, "end": None, "segments": [], "pages": groups[section]})
+        rest = [p for p, section in enumerate(carried) if section is None]
+        for first in range(0, len(rest), pages_per_section):
+            sections.append({"start": None, "end": None, "segments": [], "pages": rest[first:first + pages_per_section]})
+
+    for index, section in enumerate(sections):
+        section["index"] = index
+    return sections
+
+def _page_hash(page):
+    return hashlib.sha256((page or "").encode("utf-8")).hexdigest()[:16]
+
+def _carry_page_sections(previous, pages):
+    """
+    Riporta sulle pagine attuali la sezione che avevano nell'elaborazione precedente, così
+    aggiungere o togliere pagine dal PDF non sposta le altre in sezioni diverse.
+    Le pagine invariate sono ritrovate per hash; una pagina nuova va nella sezione della
+    pagina che la precede (o della successiva, se è in testa). Quelle aggiunte in fondo
+    restano None. Restituisce None se non c'è nulla da riportare.
+    """
+    if not previous or not len(previous["pages"]) or not len(pages):
+        return None
+    old_sections = {}
+    for section in previous["sections"]:
+        for p in section["pages"]:
+            old_sections[p] = section["index"]
+    matcher = difflib.SequenceMatcher(None, [_page_hash(page) for page in previous["pages"]],
+                                      [_page_hash(page) for page in pages], autojunk=False)
+    mapping = [None] * len(pages)
+    for old_start, new_start, size in matcher.get_matching_blocks():
+        for k in range(size):
+            mapping[new_start + k] = old_sections.get(old_start + k)
+    matched = [p for p, section in enumerate(mapping) if section is not None]
+    if not matched:
+        return None
+    for p in range(matched[0] + 1, matched[-1] + 1):
+        if mapping[p] is None:
+            mapping[p] = mapping[p - 1]
+    for p in range(matched[0]):
+        mapping[p] = mapping[matched[0]]
+    return mapping
+
+def section_sources(state, section):
+    """Restituisce (trascrizione, testo PDF) della sezione."""
+    transcript_text = " ".join(segment[2] for segment in state["segments"].read(section["segments"]))
+    pdf_text = "\n\n".join(page for page in state["pages"].read(section["pages"]) if page)
+    return transcript_text, pdf_text
+
+def section_time_ranges(state):
+    """
+    Terne (indice, inizio, fine) in secondi per le sezioni con trascrizione:
+    ogni sezione arriva fino all'inizio della successiva, così nessun tratto resta fuori.
+    """
+    sections = [s for s in state["sections"] if s["start"] is not None]
+    return [
+        (section["index"], section["start"], sections[i + 1]["start"] if i + 1 < len(sections) else section["end"])
+        for i, section in enumerate(sections)
+    ]
+
+def transcript_similarity(old_text, new_text):
+    """Somiglianza tra 0 e 1 di due trascrizioni, confrontate parola per parola."""
+    old_words = old_text.lower().split()
+    new_words = new_text.lower().split()
+    if not old_words and not new_words:
+        return 1.0
+    return difflib.SequenceMatcher(None, old_words, new_words, autojunk=False).ratio()
+
+def _source_hash(transcript_text, pdf_text):
+    return hashlib.sha256(f"{transcript_text}\0{pdf_text}".encode("utf-8")).hexdigest()[:16]
+
+def render_notes(state):
+    """Unisce le sezioni nelle note complete (None se qualche sezione manca)."""
+    if not state or not state["sections"] or any(not s.get("notes") for s in state["sections"]):
+        return None
+    return "\n\n".join(section["notes"].strip() for section in state["sections"])
+
+def format_sections(state):
+    """Elenco leggibile delle sezioni con le sorgenti collegate (numerate da 1, come nella GUI)."""
+    lines = []
+    for section in state["sections"]:
+        parts = []
+        if section["start"] is not None:
+            parts.append(f"{_format_time(section['start'])}-{_format_time(section['end'])}")
+        if section["pages"]:
+            parts.append(f"pagine {section['pages'][0] + 1}-{section['pages'][-1] + 1}")
+        title = (section.get("notes") or "").strip().splitlines()[:1]
+        lines.append(f"[{section['index'] + 1}] {', '.join(parts) or '-'}  {title[0].lstrip('# ') if title else '(da generare)'}")
+    return "\n".join(lines)
+
+def _format_time(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+async def _generate_sections(state, sections, gemini_api_key, mistral_api_key, update_callback, priority,
+                             instruction=None):
+    """Genera le note delle sezioni indicate in parallelo; restituisce quante sono fallite."""
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_SECTIONS)
+
+    async def run(section):
+        transcript_text, pdf_text = section_sources(state, section)
+        async with semaphore:
+            if update_callback:
+                update_callback("status", f"Generazione sezione {section['index'] + 1}/{len(state['sections'])}...")
+            notes = await summarize_section_async(
+                transcript_text, pdf_text, gemini_api_key, mistral_api_key, update_callback, priority=priority,
+                instruction=instruction, previous_notes=section.get("notes") if instruction else None
+            )
+        if notes:
+            section["notes"] = notes
+            section["source_hash"] = _source_hash(transcript_text, pdf_text)
+            section["instruction"] = instruction
+        return notes is not None
+
+    results = await asyncio.gather(*(run(section) for section in sections))
+    return results.count(False)
+
+async def generate_sectioned_notes_async(video_path, pdf_path, segments, pages, gemini_api_key=None, mistral_api_key=None,
+                                         update_callback=None, priority=PRIORITY_INTERACTIVE,
+                                         section_seconds=DEFAULT_SECTION_SECONDS):
+    """
+    Genera le note come sezioni collegate alle sorgenti, riusando quelle già salvate.
+    Una sezione viene rigenerata solo se la sua trascrizione o le sue pagine sono cambiate.
+
+    Args:
+        video_path: Percorso del video della lezione (può essere None).
+        pdf_path: Percorso del PDF della lezione (può essere None).
+        segments: Segmenti (inizio, fine, testo) della trascrizione: SourceSpool (vedi
+                  new_source_spools), adottato così com'è, oppure lista, copiata su disco.
+        pages: Testi delle pagine PDF, SourceSpool o lista.
+
+    Returns:
+        Note complete in Markdown o None in caso di errore.
+    """
+    sources = []
+    for kind, items in zip(_SOURCE_KINDS, (segments, pages)):
+        if not isinstance(items, SourceSpool):
+            spool = SourceSpool(_spool_path(video_path, pdf_path, kind))
+            for item in items:
+                spool.append(list(item) if kind == "segments" else item)
+            items = spool
+        sources.append(items)
+    segments, pages = sources
+
+    async with hold_lock(_lecture_lock(video_path, pdf_path)):
+        previous = load_sections(video_path, pdf_path)
+        page_sections = await asyncio.to_thread(_carry_page_sections, previous, pages)
+        state = {
+            "version": STATE_VERSION, "video_path": video_path, "pdf_path": pdf_path,
+            "segments": segments, "pages": pages,
+            "sections": await asyncio.to_thread(build_sections, segments, pages, section_seconds,
+                                                page_sections=page_sections),
+        }
+        if not state["sections"]:
+            if update_callback:
+                update_callback("error", "Nessun contenuto da suddividere in sezioni.")
+            return None
+
+        # Le note già generate vengono ritrovate per hash delle sorgenti, anche se la sezione ha cambiato posizione
+        reusable = {}
+        for section in (previous or {}).get("sections", []):
+            if section.get("notes") and section.get("source_hash"):
+                reusable.setdefault(section["source_hash"], section)
+
+        to_generate = []
+        for section in state["sections"]:
+            old = reusable.get(_source_hash(*section_sources(state, section)))
+            if old:
+                section.update(notes=old["notes"], source_hash=old["source_hash"], instruction=old.get("instruction"))
+            else:
+                to_generate.append(section)
+
+        if update_callback:
+            update_callback("status", f"Sezioni da generare: {len(to_generate)} su {len(state['sections'])}.")
+        failed = await _generate_sections(state, to_generate, gemini_api_key, mistral_api_key, update_callback, priority)
+        # Salvato anche con errori: al prossimo avvio si rigenerano solo le sezioni mancanti
+        await asyncio.to_thread(_save_state, state)
+        if failed:
+            if update_callback:
+                update_callback("error", f"Generazione non riuscita per {failed} sezioni.")
+            return None
+        return render_notes(state)
+
+def generate_sectioned_notes(video_path, pdf_path, segments, pages, gemini_api_key=None, mistral_api_key=None,
+                             update_callback=None, priority=PRIORITY_INTERACTIVE, section_seconds=DEFAULT_SECTION_SECONDS):
+    """Wrapper sincrono di generate_sectioned_notes_async."""
+    return asyncio.run(generate_sectioned_notes_async(
+        video_path, pdf_path, segments, pages, gemini_api_key, mistral_api_key, update_callback,
+        priority=priority, section_seconds=section_seconds
+    ))
+
+async def regenerate_section_async(video_path, pdf_path, section_index, instruction=None, gemini_api_key=None,
+                                   mistral_api_key=None, update_callback=None, priority=PRIORITY_INTERACTIVE):
+    """
+    Rigenera una sola sezione di una lezione già elaborata, con una richiesta opzionale
+    (es. "riscrivi in modo più sintetico"). Le altre sezioni restano invariate.
+    section_index parte da 0; all'utente le sezioni sono mostrate numerate da 1.
+
+    Returns:
+        Note complete aggiornate o None in caso di errore.
+    """
+    async with hold_lock(_lecture_lock(video_path, pdf_path)):
+        state = load_sections(video_path, pdf_path)
+        if state is None:
+            if update_callback:
+                update_callback("error", "Nessuna nota a sezioni salvata per questa lezione: elaborala prima.")
+            return None
+        if not 0 <= section_index < len(state["sections"]):
+            if update_callback:
+                update_callback("error", f"Sezione {section_index + 1} inesistente (sezioni: 1-{len(state['sections'])}).")
+            return None
+
+        failed = await _generate_sections(state, [state["sections"][section_index]], gemini_api_key, mistral_api_key,
+                                          update_callback, priority, instruction=instruction)
+        if failed:
+            return None
+        await asyncio.to_thread(_save_state, state)
+        return render_notes(state)
+
+async def replace_section_transcript_async(video_path, pdf_path, section_index, segments, gemini_api_key=None,
+                                           mistral_api_key=None, update_callback=None, priority=PRIORITY_INTERACTIVE,
+                                           min_similarity=MATERIAL_CHANGE_SIMILARITY):
+    """
+    Sostituisce la trascrizione di una sezione (es. con quella di un modello Whisper migliore).
+    Le note vengono rigenerate solo se il testo è cambiato in modo sostanziale;
+    altrimenti restano quelle attuali, collegate alla nuova trascrizione.
+
+    Args:
+        segments: Nuovi segmenti (inizio, fine, testo) della sezione.
+        min_similarity: Somiglianza minima perché il cambiamento sia considerato marginale.
+
+    Returns:
+        Coppia (note complete, True se la sezione è stata rigenerata); note None in caso di errore.
+    """
+    async with hold_lock(_lecture_lock(video_path, pdf_path)):
+        state = load_sections(video_path, pdf_path)
+        if state is None or not 0 <= section_index < len(state["sections"]):
+            if update_callback:
+                update_callback("error", f"Sezione {section_index + 1} non disponibile per questa lezione.")
+            return None, False
+
+        section = state["sections"][section_index]
+        old_text, _ = section_sources(state, section)
+        old_segments = state["segments"]
+        new_segments = SourceSpool(_spool_path(video_path, pdf_path, "segments"))
+
+        def rewrite_segments():
+            # Nuovo file dei segmenti, con quelli nuovi al posto di quelli della sezione (una sezione alla volta in RAM)
+            for other in state["sections"]:
+                replacement = [list(segment) for segment in segments] if other is section else \
+                    old_segments.read(other["segments"])
+                other["segments"] = list(range(len(new_segments), len(new_segments) + len(replacement)))
+                for segment in replacement:
+                    new_segments.append(segment)
+            new_segments.close()
+
+        await asyncio.to_thread(rewrite_segments)
+        state["segments"] = new_segments
+
+        transcript_text, pdf_text = section_sources(state, section)
+        regenerated = False
+        if section.get("notes") and transcript_similarity(old_text, transcript_text) >= min_similarity:
+            section["source_hash"] = _source_hash(transcript_text, pdf_text)
+        else:
+            regenerated = True
+            if await _generate_sections(state, [section], gemini_api_key, mistral_api_key, update_callback, priority):
+                await asyncio.to_thread(_remove_spool_files, [new_segments.path])
+                return None, True
+        await asyncio.to_thread(_save_state, state)
+        return render_notes(state), regenerated
+
+def regenerate_section(video_path, pdf_path, section_index, instruction=None, gemini_api_key=None, mistral_api_key=None,
+                       update_callback=None, priority=PRIORITY_INTERACTIVE):
+    """Wrapper sincrono di regenerate_section_async."""
+    return asyncio.run(regenerate_section_async(
+        video_path, pdf_path, section_index, instruction, gemini_api_key, mistral_api_key, update_callback, priority
+    ))
+
+def main(argv=None):
+    """Interfaccia a riga di comando: elenca o rigenera le sezioni di una lezione."""
+    parser = argparse.ArgumentParser(description="Sezioni delle note di una lezione DeepNotes.")
+    parser.add_argument("--video", help="Video della lezione")
+    parser.add_argument("--pdf", help="PDF della lezione")
+    parser.add_argument("--section", type=int, help="Numero della sezione da rigenerare, da 1 come nell'elenco e nella GUI")
+    parser.add_argument("--instruction", help="Richiesta per la sezione (es. \"più esempi\")")
+    parser.add_argument("--output", help="File in cui salvare le note complete aggiornate")
+    args = parser.parse_args(argv)
+
+    if not args.video and not args.pdf:
+        parser.error("indicare almeno --video o --pdf")
+    state = load_sections(args.video, args.pdf)
+    if state is None:
+        print("Nessuna nota a sezioni salvata per questa lezione.")
+        return 1
+    if args.section is None:
+        print(format_sections(state))
+        return 0
+
+    notes = regenerate_section(args.video, args.pdf, args.section - 1, args.instruction,
+                               update_callback=lambda status, message: print(message))
+    if notes is None:
+        return 1
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(notes)
+    else:
+        print(notes)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
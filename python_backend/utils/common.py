@@ -0,0 +1,202 @@
+import os
+import sys
+import codecs
+import asyncio
+import contextlib
+import hashlib
+import logging
+import tempfile
+
+# Configurazione di base del logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Byte tenuti in RAM da ogni TextBuffer prima di passare su disco
+DEFAULT_SPOOL_MAX_MB = 8
+# Dimensione (caratteri) dei blocchi restituiti da TextBuffer.iter_chunks
+DEFAULT_CHUNK_CHARS = 64 * 1024
+# Directory predefinita della cache (sovrascrivibile con DEEPNOTES_CACHE_DIR)
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".deepnotes", "cache")
+
+def get_cache_dir(subdir=None):
+    """Restituisce (creandola se necessario) la directory di cache, o una sua sottocartella."""
+    path = os.getenv("DEEPNOTES_CACHE_DIR") or DEFAULT_CACHE_DIR
+    if subdir:
+        path = os.path.join(path, subdir)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def file_fingerprint(path):
+    """
+    Impronta veloce di un file (percorso assoluto, dimensione, data di modifica).
+    Non legge il contenuto: cambia se il file viene sostituito o modificato.
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+def file_content_hash(path, block_size=1024 * 1024):
+    """Hash SHA-256 del contenuto di un file, letto a blocchi."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_spool_max_bytes():
+    """Soglia in byte oltre la quale i buffer di testo passano su disco (DEEPNOTES_SPOOL_MB)."""
+    try:
+        return int(float(os.getenv("DEEPNOTES_SPOOL_MB", DEFAULT_SPOOL_MAX_MB)) * 1024 * 1024)
+    except ValueError:
+        return DEFAULT_SPOOL_MAX_MB * 1024 * 1024
+
+def get_max_rss_bytes():
+    """Tetto di memoria residente configurato con DEEPNOTES_MAX_RSS_MB (None = nessun limite)."""
+    value = os.getenv("DEEPNOTES_MAX_RSS_MB")
+    if not value:
+        return None
+    try:
+        return int(float(value) * 1024 * 1024)
+    except ValueError:
+        logger.warning(f"Valore DEEPNOTES_MAX_RSS_MB non valido: {value}")
+        return None
+
+def current_rss_bytes():
+    """Memoria residente attuale del processo in byte, o None se non determinabile."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+        # Su macOS è disponibile solo il picco (in byte), su Linux è in kB
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+def peak_rss_bytes():
+    """Picco di memoria residente del processo in byte, o None se non determinabile."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+def memory_ceiling_exceeded():
+    """True se è configurato un tetto RSS e il processo lo ha superato."""
+    ceiling = get_max_rss_bytes()
+    if ceiling is None:
+        return False
+    rss = current_rss_bytes()
+    return rss is not None and rss > ceiling
+
+class TextBuffer:
+    """
+    Accumulatore di testo a memoria limitata.
+    Il testo resta in RAM fino a DEEPNOTES_SPOOL_MB, poi viene riversato in un
+    file temporaneo; lo stesso accade subito se si supera DEEPNOTES_MAX_RSS_MB.
+    Evita le concatenazioni ripetute di stringhe e permette di rileggere il
+    contenuto a blocchi senza mai materializzarlo per intero.
+    """
+
+    def __init__(self, max_memory_bytes=None):
+        self._file = tempfile.SpooledTemporaryFile(
+            max_size=max_memory_bytes if max_memory_bytes is not None else get_spool_max_bytes()
+        )
+        self._length = 0
+
+    def write(self, text):
+        """Aggiunge testo in coda al buffer."""
+        if not text:
+            return
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(text.encode("utf-8"))
+        self._length += len(text)
+        if not self.on_disk and memory_ceiling_exceeded():
+            logger.info("Tetto di memoria superato: il buffer di testo viene spostato su disco.")
+            self._file.rollover()
+
+    @property
+    def on_disk(self):
+        """True se il contenuto è già stato riversato su disco."""
+        return getattr(self._file, "_rolled", False)
+
+    def iter_chunks(self, chunk_chars=DEFAULT_CHUNK_CHARS):
+        """
+        Restituisce il contenuto a blocchi di circa chunk_chars caratteri.
+        I tagli avvengono su uno spazio bianco quando possibile, così le parole
+        non vengono spezzate (utile per l'indicizzazione full-text).
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        self._file.seek(0)
+        carry = ""
+        while True:
+            block = self._file.read(chunk_chars)
+            text = carry + decoder.decode(block, final=not block)
+            if not block:
+                if text:
+                    yield text
+                break
+            cut = max(text.rfind(" "), text.rfind("\n"))
+            if cut <= 0 or len(text) - cut > chunk_chars:
+                cut = len(text)
+            else:
+                cut += 1
+            carry = text[cut:]
+            if text[:cut]:
+                yield text[:cut]
+        self._file.seek(0, os.SEEK_END)
+
+    def getvalue(self):
+        """Restituisce l'intero contenuto come stringa (da usare solo se indispensabile)."""
+        return "".join(self.iter_chunks())
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+    def close(self):
+        """Libera la memoria o il file temporaneo associato."""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def iter_text_chunks(content, chunk_chars=DEFAULT_CHUNK_CHARS):
+    """Itera a blocchi su una stringa o su un TextBuffer."""
+    if not content:
+        return
+    if isinstance(content, TextBuffer):
+        yield from content.iter_chunks(chunk_chars)
+    else:
+        for start in range(0, len(content), chunk_chars):
+            yield content[start:start + chunk_chars]
+
+def text_value(content):
+    """Restituisce il contenuto come stringa, sia che sia str sia TextBuffer."""
+    if isinstance(content, TextBuffer):
+        return content.getvalue()
+    return content
+
+@contextlib.asynccontextmanager
+async def hold_lock(lock, poll_seconds=0.05):
+    """
+    Acquisisce un threading.Lock da codice asyncio senza bloccare l'event loop.
+    Il lock viene preso nel thread del loop con tentativi non bloccanti: se il task
+    viene annullato durante l'attesa il lock non resta acquisito, come invece
+    accadrebbe con asyncio.to_thread(lock.acquire).
+    """
+    while not lock.acquire(blocking=False):
+        await asyncio.sleep(poll_seconds)
+    try:
+        yield
+    finally:
+        lock.release()
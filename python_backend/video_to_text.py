@@ -1,25 +1,224 @@
 import os
 import time
+import uuid
+import asyncio
 import tempfile
 import logging
+import functools
+import threading
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import ffmpeg
 from faster_whisper import WhisperModel
+from .utils.common import TextBuffer, get_cache_dir, file_fingerprint
 
 # Configurazione di base del logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def extract_and_transcribe(video_path, update_callback=None, model_size="base"):
+# Un solo worker: più trascrizioni Whisper in parallelo si contenderebbero la stessa CPU
+_transcription_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="whisper")
+
+# Durata dei blocchi (secondi) per l'estrazione parallela a intervalli
+DEFAULT_CHUNK_SECONDS = 600
+# Processi ffmpeg contemporanei durante l'estrazione a blocchi
+MAX_PARALLEL_EXTRACTIONS = min(4, os.cpu_count() or 1)
+# Spazio massimo della cache audio (sovrascrivibile con DEEPNOTES_AUDIO_CACHE_MB)
+DEFAULT_AUDIO_CACHE_MB = 2048
+
+# Modelli Whisper tenuti in memoria: bozza veloce e modello di affinamento insieme, non di più
+MAX_LOADED_WHISPER_MODELS = 2
+_whisper_model_lock = threading.Lock()
+_whisper_models = OrderedDict()
+
+class ExtractionCancelled(Exception):
+    """L'estrazione audio è stata annullata (ad esempio dal prefetch speculativo)."""
+
+def get_whisper_model(model_size):
+    """
+    Restituisce il modello Whisper richiesto, caricandolo solo se non è già in memoria.
+    Un caricamento in corso in un altro thread (es. warm-up) viene atteso invece che ripetuto.
+    """
+    with _whisper_model_lock:
+        model = _whisper_models.get(model_size)
+        if model is None:
+            # Rilascia il modello usato meno di recente prima di caricare il nuovo
+            while len(_whisper_models) >= MAX_LOADED_WHISPER_MODELS:
+                _whisper_models.popitem(last=False)
+            model = WhisperModel(model_size, device="cpu", compute_type="int8")
+            _whisper_models[model_size] = model
+        _whisper_models.move_to_end(model_size)
+        return model
+
+def probe_media(video_path):
+    """
+    Legge i metadati del file con ffprobe, senza decodificare nulla.
+
+    Returns:
+        Dizionario con 'duration' (secondi o None), 'audio_codec' (o None se
+        manca la traccia audio), 'audio_index' e 'format_name'.
+    """
+    info = ffmpeg.probe(video_path)
+    audio_streams = [s for s in info.get("streams", []) if s.get("codec_type") == "audio"]
+    duration = info.get("format", {}).get("duration")
+    return {
+        "duration": float(duration) if duration else None,
+        "audio_codec": audio_streams[0].get("codec_name") if audio_streams else None,
+        "audio_index": audio_streams[0].get("index") if audio_streams else None,
+        "format_name": info.get("format", {}).get("format_name"),
+    }
+
+def _get_audio_cache_limit():
+    try:
+        return int(float(os.getenv("DEEPNOTES_AUDIO_CACHE_MB", DEFAULT_AUDIO_CACHE_MB)) * 1024 * 1024)
+    except ValueError:
+        return DEFAULT_AUDIO_CACHE_MB * 1024 * 1024
+
+def _trim_audio_cache(cache_dir):
+    """Elimina i file audio usati meno di recente oltre il limite della cache."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        # I file .part sono estrazioni ancora in corso
+        if os.path.isfile(path) and not name.endswith(".part"):
+            stat = os.stat(path)
+            entries.append((stat.st_atime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    limit = _get_audio_cache_limit()
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            logger.warning(f"Impossibile rimuovere {path} dalla cache audio: {e}")
+
+def _run_extraction(video_path, output_path, start=None, end=None, copy=True, cancel_event=None):
+    """
+    Estrae solo la traccia audio nell'intervallo [start, end).
+    Con copy=True i pacchetti audio vengono copiati senza decodifica (Matroska
+    accetta qualsiasi codec); altrimenti l'audio viene decodificato in WAV 16 kHz mono.
+    Il video non viene mai decodificato. Se cancel_event viene impostato, il
+    processo ffmpeg viene terminato e si solleva ExtractionCancelled.
+    """
+    input_args = {}
+    if start:
+        # -ss prima di -i: ricerca veloce senza leggere la parte precedente
+        input_args["ss"] = start
+    if end is not None:
+        input_args["t"] = end - (start or 0)
+    # Solo la prima traccia audio (-map 0:a:0): video e sottotitoli non vengono letti
+    stream = ffmpeg.input(video_path, **input_args)['a:0']
+    if copy:
+        output = stream.output(output_path, acodec="copy", f="matroska")
+    else:
+        output = stream.output(
+            output_path,
+            acodec='pcm_s16le',  # Codec audio WAV standard
+            ar='16000',          # Frequenza di campionamento per Whisper
+            ac=1,                # Mono canale
+            f="wav"
+        )
+    process = output.overwrite_output().global_args('-loglevel', 'error').run_async(
+        cmd='ffmpeg', pipe_stdout=True, pipe_stderr=True
+    )
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=0.2)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel_event is not None and cancel_event.is_set():
+                process.kill()
+                process.communicate()
+                raise ExtractionCancelled(f"Estrazione audio annullata: {os.path.basename(video_path)}")
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', stdout, stderr)
+
+def extract_audio(video_path, output_dir=None, start=None, end=None, use_cache=True, cancel_event=None):
+    """
+    Estrae l'audio di un video (o di un suo intervallo) in un file leggibile da Whisper.
+    Prova prima la copia diretta della traccia audio, poi la decodifica in WAV.
+    Con use_cache il risultato viene riutilizzato nelle esecuzioni successive
+    sullo stesso file, finché il file non cambia.
+
+    Args:
+        video_path: Percorso al file video.
+        output_dir: Directory di destinazione se use_cache è False.
+        start: Inizio dell'intervallo in secondi (opzionale).
+        end: Fine dell'intervallo in secondi (opzionale).
+        use_cache: Se True usa la cache audio su disco.
+        cancel_event: threading.Event che, se impostato, interrompe l'estrazione.
+
+    Returns:
+        Percorso del file audio estratto.
+    """
+    range_key = f"{start or 0:g}-{end:g}" if end is not None else f"{start or 0:g}-end"
+    base_name = f"{file_fingerprint(video_path)}_{range_key}"
+    target_dir = get_cache_dir("audio") if use_cache else (output_dir or tempfile.mkdtemp())
+
+    if use_cache:
+        for ext in (".mka", ".wav"):
+            cached = os.path.join(target_dir, base_name + ext)
+            if os.path.exists(cached):
+                os.utime(cached)  # Aggiorna l'ultimo accesso per la politica LRU
+                logger.info(f"Audio riutilizzato dalla cache: {cached}")
+                return cached
+
+    # Scrittura su un file temporaneo e rinomina atomica: niente file parziali in cache
+    part_suffix = f".{uuid.uuid4().hex}.part"
+    copy_path = os.path.join(target_dir, base_name + ".mka")
+    wav_path = os.path.join(target_dir, base_name + ".wav")
+    try:
+        try:
+            _run_extraction(video_path, copy_path + part_suffix, start, end, copy=True, cancel_event=cancel_event)
+            os.replace(copy_path + part_suffix, copy_path)
+            result = copy_path
+        except ffmpeg.Error as copy_error:
+            logger.info(f"Copia diretta dell'audio non riuscita, decodifica in WAV: {copy_error.stderr.decode(errors='ignore')[-200:] if copy_error.stderr else copy_error}")
+            _run_extraction(video_path, wav_path + part_suffix, start, end, copy=False, cancel_event=cancel_event)
+            os.replace(wav_path + part_suffix, wav_path)
+            result = wav_path
+    finally:
+        # Rimuove eventuali file parziali (errore o annullamento)
+        for leftover in (copy_path + part_suffix, wav_path + part_suffix):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    if use_cache:
+        _trim_audio_cache(target_dir)
+    return result
+
+def _chunk_ranges(start, end, chunk_seconds):
+    """Suddivide [start, end) in intervalli consecutivi di chunk_seconds secondi."""
+    ranges = []
+    position = start
+    while position < end:
+        ranges.append((position, min(position + chunk_seconds, end)))
+        position += chunk_seconds
+    return ranges
+
+def extract_and_transcribe(video_path, update_callback=None, model_size="base", stream=False,
+                           start=None, end=None, chunk_seconds=None, use_cache=True, segment_callback=None):
     """
     Estrae l'audio da un video usando ffmpeg e lo trascrive con faster-whisper.
-    
+
     Args:
         video_path: Percorso al file video.
         update_callback: Funzione callback per aggiornare lo stato nell'UI (opzionale).
         model_size: Dimensione del modello Whisper da utilizzare.
-        
+        stream: Se True restituisce un TextBuffer (memoria limitata) invece di una stringa.
+        start: Secondo da cui iniziare la trascrizione (opzionale).
+        end: Secondo a cui terminare la trascrizione (opzionale).
+        chunk_seconds: Se indicato, l'audio viene estratto in blocchi di questa durata
+            in parallelo e ogni blocco viene trascritto appena pronto.
+        use_cache: Se True riutilizza l'audio già estratto per lo stesso file.
+        segment_callback: Funzione chiamata per ogni segmento con (inizio, fine, testo),
+            tempi in secondi dall'inizio del video.
+
     Returns:
-        Testo trascritto o None in caso di errore.
+        Testo trascritto (str o TextBuffer) o None in caso di errore.
     """
     try:
         # Helper function for logging with or without callback
@@ -30,67 +229,107 @@ def extract_and_transcribe(video_path, update_callback=None, model_size="base"):
                 logger.error(message)
             else:
                 logger.info(message)
-                
+
         # Verifica esistenza del file video
         if not os.path.exists(video_path):
             log_update("error", f"File video non trovato: {video_path}")
             return None
-            
+
         log_update("status", f"Inizio elaborazione video: {os.path.basename(video_path)}...")
-        
-        # Creazione directory temporanea per l'audio estratto
+
+        # Analisi del contenitore con ffprobe (nessuna decodifica)
+        try:
+            media = probe_media(video_path)
+        except ffmpeg.Error as e:
+            error_message = f"Errore durante l'analisi del file con ffprobe: {e.stderr.decode() if e.stderr else str(e)}"
+            log_update("error", error_message)
+            return None
+        if media["audio_codec"] is None:
+            log_update("error", f"Il file {os.path.basename(video_path)} non contiene una traccia audio.")
+            return None
+
+        range_start = start or 0
+        range_end = end if end is not None else media["duration"]
+        if chunk_seconds and range_end and range_end - range_start > chunk_seconds:
+            ranges = _chunk_ranges(range_start, range_end, chunk_seconds)
+        else:
+            ranges = [(start, end)]
+
+        # Creazione directory temporanea per l'audio estratto (se la cache è disattivata)
         with tempfile.TemporaryDirectory() as temp_dir:
-            # Definizione percorso del file audio temporaneo
-            audio_output_path = os.path.join(temp_dir, "audio.wav")
-            
-            # Estrazione audio con ffmpeg
-            log_update("status", "Inizio estrazione audio...")
+            # Estrazione audio con ffmpeg: i blocchi vengono estratti in parallelo
+            log_update("status", f"Inizio estrazione audio ({media['audio_codec']}, {len(ranges)} blocchi)...")
+            extraction_start = time.perf_counter()
+            pool = ThreadPoolExecutor(max_workers=MAX_PARALLEL_EXTRACTIONS, thread_name_prefix="ffmpeg")
             try:
-                # Utilizzo di ffmpeg per estrarre l'audio in formato WAV
-                ffmpeg.input(video_path).output(
-                    audio_output_path,
-                    acodec='pcm_s16le',  # Codec audio WAV standard
-                    ar='16000',          # Frequenza di campionamento per Whisper
-                    ac=1                 # Mono canale
-                ).run(
-                    cmd='ffmpeg',
-                    capture_stdout=True,
-                    capture_stderr=True
-                )
-            except ffmpeg.Error as e:
-                error_message = f"Errore durante l'estrazione audio con FFmpeg: {e.stderr.decode() if e.stderr else str(e)}"
-                logger.error(error_message)
-                log_update("error", error_message)
-                return None
-                
-            log_update("status", f"Estrazione audio completata. Inizio trascrizione con modello '{model_size}'...")
-            
-            # Inizializzazione del modello Whisper
-            try:
-                log_update("status", f"Inizializzazione modello Whisper '{model_size}'...")
-                model = WhisperModel(model_size, device="cpu", compute_type="int8")
-                
-                # Trascrizione dell'audio
-                log_update("status", "Modello pronto, inizio trascrizione...")
-                segments, _ = model.transcribe(audio_output_path, word_timestamps=False)
-                
-                # Costruzione del testo completo dai segmenti
-                transcription = ""
-                for segment in segments:
-                    transcription += segment.text + " "
-                
-                log_update("status", "Trascrizione video completata.")
-                return transcription.strip()
-                
-            except Exception as whisper_error:
-                error_message = f"Errore durante la trascrizione con Whisper: {str(whisper_error)}"
-                logger.error(error_message)
-                log_update("error", error_message)
-                return None
-                
+                futures = [
+                    pool.submit(extract_audio, video_path, temp_dir, range_from, range_to, use_cache)
+                    for range_from, range_to in ranges
+                ]
+
+                # Inizializzazione del modello Whisper mentre ffmpeg lavora
+                try:
+                    log_update("status", f"Inizializzazione modello Whisper '{model_size}'...")
+                    model = get_whisper_model(model_size)
+                except Exception as whisper_error:
+                    error_message = f"Errore durante la trascrizione con Whisper: {str(whisper_error)}"
+                    log_update("error", error_message)
+                    return None
+
+                # Costruzione del testo completo dai segmenti, senza concatenazioni ripetute
+                transcription = TextBuffer()
+                for i, future in enumerate(futures):
+                    try:
+                        audio_output_path = future.result()
+                    except ffmpeg.Error as e:
+                        transcription.close()
+                        error_message = f"Errore durante l'estrazione audio con FFmpeg: {e.stderr.decode() if e.stderr else str(e)}"
+                        log_update("error", error_message)
+                        return None
+                    if i == 0:
+                        log_update("status", f"Estrazione audio pronta in {time.perf_counter() - extraction_start:.1f}s. Inizio trascrizione con modello '{model_size}'...")
+                    elif len(futures) > 1:
+                        log_update("status", f"Trascrizione blocco {i + 1}/{len(futures)}...")
+
+                    # Trascrizione dell'audio (faster-whisper decodifica e ricampiona da sé)
+                    offset = ranges[i][0] or 0
+                    try:
+                        segments, _ = model.transcribe(audio_output_path, word_timestamps=False)
+                        for segment in segments:
+                            text = segment.text.strip()
+                            if text:
+                                transcription.write((" " if transcription else "") + text)
+                                if segment_callback:
+                                    segment_callback(segment.start + offset, segment.end + offset, text)
+                    except Exception as whisper_error:
+                        transcription.close()
+                        error_message = f"Errore durante la trascrizione con Whisper: {str(whisper_error)}"
+                        log_update("error", error_message)
+                        return None
+            finally:
+                # Con un errore i blocchi non ancora avviati vengono annullati
+                pool.shutdown(wait=True, cancel_futures=True)
+
+        log_update("status", "Trascrizione video completata.")
+        if stream:
+            return transcription
+        with transcription:
+            return transcription.getvalue()
+
     except Exception as e:
         error_message = f"Errore durante l'elaborazione video: {str(e)}"
         logger.error(error_message)
         if update_callback:
             update_callback("error", error_message)
         return None
+
+async def extract_and_transcribe_async(video_path, update_callback=None, model_size="base", stream=False, **kwargs):
+    """
+    Variante asyncio di extract_and_transcribe: FFmpeg e Whisper sono bloccanti e
+    vengono eseguiti in un executor dedicato, senza bloccare l'event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _transcription_executor,
+        functools.partial(extract_and_transcribe, video_path, update_callback, model_size, stream, **kwargs)
+    )